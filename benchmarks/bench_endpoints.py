@@ -0,0 +1,397 @@
+"""
+Benchmark de bout en bout des endpoints FKStream (/stream, /meta, /catalog, /playback).
+
+Génère un dataset synthétique (N animes, M torrents par anime, K fichiers par torrent),
+simule l'API Fankai, StremThru et la liste de renommage avec des applications ASGI locales,
+puis mesure la latence (p50/p90/p99) et les allocations mémoire de chaque endpoint.
+Aucun accès réseau n'est effectué. Les résultats sont écrits au format JSON.
+
+Exemples :
+    python benchmarks/bench_endpoints.py --animes 200 --torrents 5 --files 24 --output bench.json
+    python benchmarks/bench_endpoints.py --baseline bench.json --max-regression 0.25
+"""
+import os
+import sys
+import json
+import time
+import base64
+import asyncio
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+ENDPOINTS = ("stream", "stream_cached", "meta", "catalog", "playback")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark des endpoints FKStream sur un dataset synthétique.")
+    parser.add_argument("--animes", type=int, default=200, help="Nombre d'animes (N)")
+    parser.add_argument("--torrents", type=int, default=5, help="Nombre de torrents par anime (M)")
+    parser.add_argument("--files", type=int, default=24, help="Nombre de fichiers par torrent (K)")
+    parser.add_argument("--requests", type=int, default=200, help="Nombre de requêtes mesurées par endpoint")
+    parser.add_argument("--alloc-requests", type=int, default=50, help="Nombre de requêtes mesurées sous tracemalloc")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help=f"Endpoints à mesurer parmi {', '.join(ENDPOINTS)}")
+    parser.add_argument("--output", help="Fichier JSON de sortie (stdout par défaut)")
+    parser.add_argument("--baseline", help="Résultats JSON de référence à comparer")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="Dégradation relative tolérée des p50/p99 face à la référence")
+    parser.add_argument("--verbose", action="store_true", help="Afficher les logs de FKStream")
+    return parser.parse_args()
+
+
+def configure_environment(workdir: str) -> None:
+    """Doit être appelé avant tout import de fkstream : les settings sont lus à l'import."""
+    os.environ.update({
+        "FANKAI_URL": "http://fankai.bench",
+        "API_KEY": "bench",
+        "STREMTHRU_URL": "http://stremthru.bench",
+        "DATABASE_TYPE": "sqlite",
+        "DATABASE_PATH": os.path.join(workdir, "fkstream.db"),
+        "DATASET_SNAPSHOT_PATH": os.path.join(workdir, "dataset.snapshot"),
+        "DATASET_REFRESH_INTERVAL": "0",
+        "CUSTOM_SOURCE_URL": "",
+        "CUSTOM_SOURCE_PATH": os.path.join(workdir, "custom_sources.json"),
+        "DEBRID_PROXY_URL": "",
+        "LOG_LEVEL": "PRODUCTION",
+    })
+
+
+# ==================================================================== #
+# Données synthétiques                                                  #
+# ==================================================================== #
+
+def info_hash(anime_id: int, torrent: int) -> str:
+    return f"{anime_id:020x}{torrent:020x}"
+
+
+def episode_id(anime_id: int, episode: int) -> int:
+    return anime_id * 10_000 + episode
+
+
+def build_synthetic_data(animes: int, torrents: int, files: int) -> dict:
+    qualities = ("1080p", "720p", "480p", "2160p", "MULTI")
+    genres = ("Action", "Aventure", "Comédie", "Drame", "Fantastique", "Shonen")
+    dataset = {"top": []}
+    series = []
+    episodes = {}
+
+    for anime_id in range(1, animes + 1):
+        title = f"Anime Synthétique {anime_id}"
+        sources = []
+        for torrent in range(torrents):
+            quality = qualities[torrent % len(qualities)]
+            sources.append({
+                "magnet": (
+                    f"magnet:?xt=urn:btih:{info_hash(anime_id, torrent)}&amp;dn={quote_name(title)}"
+                    "&amp;tr=udp%3A%2F%2Ftracker.opentrackr.org%3A1337%2Fannounce"
+                    "&amp;tr=udp%3A%2F%2Fopen.stealth.si%3A80%2Fannounce"
+                ),
+                "files": [f"{title}/{title} - {episode:02d} [{quality}].mkv" for episode in range(1, files + 1)],
+                "size": 1_500_000_000 + torrent,
+                "seeders": (anime_id + torrent) % 50,
+                "leechers": torrent,
+                "uploaded_at": "2024-01-01T00:00:00",
+            })
+        dataset["top"].append({"api_id": anime_id, "name": title, "description": "x" * 200, "sources": sources})
+
+        series.append({
+            "id": anime_id,
+            "title": title,
+            "genres": ", ".join(genres[(anime_id + offset) % len(genres)] for offset in range(2)),
+            "rating_value": anime_id % 10,
+            "year": 1990 + anime_id % 35,
+            "last_update": f"2024-{anime_id % 12 + 1:02d}-{anime_id % 28 + 1:02d} 12:00:00",
+            "plot": "Résumé synthétique. " * 10,
+            "poster_image": f"https://img.bench/{anime_id}/poster.jpg",
+            "fanart_image": f"https://img.bench/{anime_id}/fanart.jpg",
+            "logo_image": f"https://img.bench/{anime_id}/logo.png",
+            "trailer_url": "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+            "imdb_id": f"tt{anime_id:07d}",
+        })
+        episodes[anime_id] = [{
+            "id": episode_id(anime_id, episode),
+            "title": f"Épisode {episode}",
+            "episode_number": episode,
+            "season_number": 1,
+            "nfo_filename": f"{title} - {episode:02d}.nfo",
+            "aired": "2024-01-01",
+            "plot": "Résumé d'épisode.",
+        } for episode in range(1, files + 1)]
+
+    return {"dataset": dataset, "series": series, "episodes": episodes}
+
+
+def quote_name(name: str) -> str:
+    from urllib.parse import quote
+    return quote(name, safe="")
+
+
+# ==================================================================== #
+# Services simulés                                                      #
+# ==================================================================== #
+
+def build_fake_services(data: dict) -> dict:
+    from fastapi import FastAPI, Response
+
+    dataset_body = json.dumps(data["dataset"]).encode()
+    series_by_id = {serie["id"]: serie for serie in data["series"]}
+
+    fankai = FastAPI()
+
+    @fankai.get("/dataset")
+    async def dataset():
+        return Response(dataset_body, media_type="application/json", headers={"ETag": '"bench"'})
+
+    @fankai.get("/series")
+    async def all_series():
+        return data["series"]
+
+    @fankai.get("/series/{series_id}")
+    async def series_details(series_id: int):
+        return series_by_id.get(series_id, {})
+
+    @fankai.get("/series/{series_id}/seasons")
+    async def seasons(series_id: int):
+        return {"seasons": [{"id": series_id, "season_number": 1}]}
+
+    @fankai.get("/seasons/{season_id}/episodes")
+    async def episodes(season_id: int):
+        return {"episodes": data["episodes"].get(season_id, [])}
+
+    @fankai.get("/series/{series_id}/actors")
+    async def actors(series_id: int):
+        return {"actors": [{"name": f"Acteur {index}", "role": "Rôle", "image": None} for index in range(15)]}
+
+    stremthru = FastAPI()
+
+    @stremthru.get("/v0/store/user")
+    async def user():
+        return {"data": {"subscription_status": "premium"}}
+
+    @stremthru.get("/v0/store/magnets/check")
+    async def magnets_check(magnet: str):
+        return {"data": {"items": [
+            {"hash": value, "status": "cached" if int(value[-1], 16) % 2 == 0 else "downloading"}
+            for value in magnet.split(",")
+        ]}}
+
+    @stremthru.post("/v0/store/magnets")
+    async def magnets_add(payload: dict):
+        hash_value = payload["magnet"].split("btih:")[1][:40]
+        anime_id = int(hash_value[:20], 16)
+        title = f"Anime Synthétique {anime_id}"
+        files = [{"index": index, "name": f"{title} - {index + 1:02d} [1080p].mkv", "size": 1_000_000, "link": f"https://st.bench/{hash_value}/{index}"}
+                 for index in range(len(data["episodes"].get(anime_id, [])))]
+        return {"data": {"status": "cached", "hash": hash_value, "files": files}}
+
+    @stremthru.post("/v0/store/link/generate")
+    async def link_generate(payload: dict):
+        return {"data": {"link": f"{payload['link']}/direct.mkv"}}
+
+    github = FastAPI()
+
+    @github.get("/{path:path}")
+    async def rename_list(path: str):
+        return Response("Ancien Titre -> Nouveau Titre\n", media_type="text/plain")
+
+    return {"fankai.bench": fankai, "stremthru.bench": stremthru, "raw.githubusercontent.com": github}
+
+
+def install_offline_transport(services: dict) -> None:
+    """Redirige tous les appels sortants de HttpClient vers les services simulés."""
+    import httpx
+    from fkstream.utils.http_client import HttpClient
+
+    class OfflineTransport(httpx.AsyncBaseTransport):
+        def __init__(self):
+            self._transports = {host: httpx.ASGITransport(app) for host, app in services.items()}
+
+        async def handle_async_request(self, request):
+            transport = self._transports.get(request.url.host)
+            if transport is None:
+                raise httpx.ConnectError(f"Accès réseau interdit pendant le benchmark: {request.url}", request=request)
+            return await transport.handle_async_request(request)
+
+    def _setup_client(self):
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(self.timeout),
+            headers={"User-Agent": self.user_agent},
+            follow_redirects=True,
+            transport=OfflineTransport(),
+        )
+
+    HttpClient._setup_client = _setup_client
+
+
+# ==================================================================== #
+# Mesures                                                               #
+# ==================================================================== #
+
+def encode_config(**overrides) -> str:
+    config = {"debridService": "torrent", "debridApiKey": "", "streamFilter": "all", "maxActorsDisplay": "all", **overrides}
+    return base64.urlsafe_b64encode(json.dumps(config).encode()).decode()
+
+
+def build_paths(args) -> dict:
+    debrid_config = encode_config(debridService="realdebrid", debridApiKey="BENCHKEY")
+    stream_paths, meta_paths, playback_paths = [], [], []
+    for index in range(args.requests):
+        anime_id = index % args.animes + 1
+        episode = index % args.files + 1
+        media_id = f"fk:{anime_id}:{episode_id(anime_id, episode)}"
+        config = debrid_config if index % 2 else encode_config()
+        stream_paths.append(f"/{config}/stream/anime/{media_id}.json")
+        meta_paths.append(f"/meta/anime/fk:{anime_id}.json")
+        b64_media_id = base64.urlsafe_b64encode(media_id.encode()).decode()
+        filename = quote_name(f"Anime Synthétique {anime_id} - {episode:02d} [1080p].mkv")
+        playback_paths.append(f"/{debrid_config}/playback/{b64_media_id}/{info_hash(anime_id, 0)}/{episode - 1}/{filename}")
+
+    catalog_paths = [
+        "/catalog/anime/fankai_catalog.json",
+        "/catalog/anime/fankai_catalog/sort=title.json",
+        "/catalog/anime/fankai_catalog/search=synthetique 1.json",
+        "/catalog/anime/fankai_catalog/genre=Comédie.json",
+    ]
+    return {
+        "stream": stream_paths,
+        "stream_cached": stream_paths,
+        "meta": meta_paths,
+        "catalog": [catalog_paths[index % len(catalog_paths)] for index in range(args.requests)],
+        "playback": playback_paths,
+    }
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[rank]
+
+
+async def measure_endpoint(client, name: str, paths: list, alloc_requests: int) -> dict:
+    from fkstream.utils.response_cache import stream_cache
+
+    # /stream est mesuré sans le cache de réponses pour couvrir toute la chaîne ; stream_cached le mesure à chaud
+    reset_cache = stream_cache.clear if name == "stream" else (lambda: None)
+
+    # Préchauffage : métadonnées en base, tables de correspondance, cache de disponibilité
+    # et vérification que le scénario exerce bien le chemin nominal
+    for path in dict.fromkeys(paths):
+        response = await client.get(path)
+        if response.status_code != (302 if name == "playback" else 200):
+            raise RuntimeError(f"{path} -> {response.status_code}")
+        if name.startswith("stream") and not response.json()["streams"]:
+            raise RuntimeError(f"{path} -> aucun stream")
+
+    latencies_ms = []
+    for path in paths:
+        reset_cache()
+        start = time.perf_counter_ns()
+        await client.get(path)
+        latencies_ms.append((time.perf_counter_ns() - start) / 1e6)
+
+    peaks_kib, retained_kib = [], []
+    tracemalloc.start()
+    try:
+        for path in paths[:alloc_requests]:
+            reset_cache()
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            await client.get(path)
+            current, peak = tracemalloc.get_traced_memory()
+            peaks_kib.append((peak - before) / 1024)
+            retained_kib.append((current - before) / 1024)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "requests": len(latencies_ms),
+        "mean_ms": round(sum(latencies_ms) / len(latencies_ms), 3),
+        "p50_ms": round(percentile(latencies_ms, 0.50), 3),
+        "p90_ms": round(percentile(latencies_ms, 0.90), 3),
+        "p99_ms": round(percentile(latencies_ms, 0.99), 3),
+        "max_ms": round(max(latencies_ms), 3),
+        "alloc_requests": len(peaks_kib),
+        "alloc_peak_kib_p50": round(percentile(peaks_kib, 0.50), 1),
+        "alloc_peak_kib_p99": round(percentile(peaks_kib, 0.99), 1),
+        "alloc_retained_kib_mean": round(sum(retained_kib) / len(retained_kib), 1) if retained_kib else 0.0,
+    }
+
+
+async def run_benchmark(args, data: dict) -> dict:
+    import httpx
+    from fkstream.main import app
+
+    results = {}
+    paths = build_paths(args)
+    startup = time.perf_counter()
+    async with app.router.lifespan_context(app):
+        startup_seconds = time.perf_counter() - startup
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app), base_url="http://fkstream.bench") as client:
+            for name in args.endpoints.split(","):
+                name = name.strip()
+                if name not in paths:
+                    raise SystemExit(f"Endpoint inconnu: {name}")
+                results[name] = await measure_endpoint(client, name, paths[name], args.alloc_requests)
+                print_summary_line(name, results[name])
+
+    return {
+        "parameters": {"animes": args.animes, "torrents": args.torrents, "files": args.files, "requests": args.requests},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "timestamp": time.time()},
+        "startup_seconds": round(startup_seconds, 3),
+        "results": results,
+    }
+
+
+def print_summary_line(name: str, result: dict) -> None:
+    print(
+        f"{name:<14} p50 {result['p50_ms']:>8.2f} ms  p99 {result['p99_ms']:>8.2f} ms  "
+        f"alloc p50 {result['alloc_peak_kib_p50']:>8.1f} Kio  p99 {result['alloc_peak_kib_p99']:>8.1f} Kio",
+        file=sys.stderr,
+    )
+
+
+def compare_with_baseline(report: dict, baseline_path: str, max_regression: float) -> list:
+    baseline = json.loads(Path(baseline_path).read_text())
+    regressions = []
+    for name, result in report["results"].items():
+        reference = baseline.get("results", {}).get(name)
+        if not reference:
+            continue
+        for metric in ("p50_ms", "p99_ms"):
+            if reference[metric] > 0 and result[metric] > reference[metric] * (1 + max_regression):
+                regressions.append(f"{name}.{metric}: {reference[metric]:.2f} -> {result[metric]:.2f} ms")
+    return regressions
+
+
+def main() -> int:
+    args = parse_args()
+    with tempfile.TemporaryDirectory(prefix="fkstream-bench-") as workdir:
+        configure_environment(workdir)
+        sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+        if not args.verbose:
+            from fkstream.utils.common_logger import logger
+            logger.disable("fkstream")
+
+        data = build_synthetic_data(args.animes, args.torrents, args.files)
+        install_offline_transport(build_fake_services(data))
+        report = asyncio.run(run_benchmark(args, data))
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    else:
+        print(output)
+
+    if args.baseline:
+        regressions = compare_with_baseline(report, args.baseline, args.max_regression)
+        for regression in regressions:
+            print(f"RÉGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
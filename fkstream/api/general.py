@@ -1,6 +1,11 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Request
 from fastapi.responses import RedirectResponse
 
+from fkstream.utils.models import settings
+from fkstream.utils.database import metadata_memory_cache
+from fkstream.utils.metadata_warmer import metadata_warmer
+from fkstream.utils.response_cache import meta_cache, stream_cache
+
 general_router = APIRouter(tags=["General"])
 
 
@@ -11,6 +16,17 @@ async def root():
 
 
 @general_router.get("/health")
-async def health():
+async def health(request: Request):
     """Endpoint de verification de l'etat de sante de l'application."""
-    return {"status": "ok"}
+    dataset_index = getattr(request.app.state, "dataset_index", None)
+    return {
+        "status": "ok",
+        "dataset": {
+            **(dataset_index.stats if dataset_index else {}),
+            "refresh_interval": settings.DATASET_REFRESH_INTERVAL,
+        },
+        "metadata_cache": metadata_memory_cache.stats(),
+        "metadata_warmer": metadata_warmer.stats(),
+        "stream_cache": stream_cache.stats(),
+        "meta_cache": meta_cache.stats(),
+    }
@@ -1,9 +1,8 @@
-import re
 import asyncio
 from pathlib import Path
-from urllib.parse import quote, parse_qs, urlparse
-import html
+from urllib.parse import quote
 
+import orjson
 from fastapi import APIRouter, Depends, Request
 
 from fkstream.debrid.manager import get_debrid_extension
@@ -11,11 +10,12 @@ from fkstream.scrapers.fankai import FankaiAPI, get_or_fetch_anime_details
 from fkstream.scrapers.videas import scrape_videas_url
 from fkstream.utils.common_logger import logger
 from fkstream.utils.dependencies import get_fankai_api
-from fkstream.utils.general import b64_encode, normalize_name
+from fkstream.utils.general import b64_encode, stremio_cache_hints
 from fkstream.utils.config_validator import config_check
-from fkstream.utils.models import Anime, Episode
-from fkstream.utils.stream_utils import find_best_file_for_episode
-from fkstream.utils.magnet_store import store_magnet_link
+from fkstream.utils.database import get_cache_version, record_anime_request, stream_version_key
+from fkstream.utils.models import Anime, Episode, settings
+from fkstream.utils.response_cache import CachedResponse, cached_json_response, stream_cache, hash_secret
+from fkstream.utils.stream_utils import precompute_episode_matches, get_matched_file_index
 
 from fastapi.responses import RedirectResponse, FileResponse
 from fkstream.utils.general import get_client_ip, b64_decode
@@ -25,17 +25,15 @@ from fkstream.debrid.manager import build_stremthru_token
 stream_router = APIRouter(tags=["Stremio"])
 
 _UNCACHED_VIDEO = Path(__file__).resolve().parent.parent / "assets" / "uncached.mp4"
+# Validité annoncée à Stremio quand la liste de flux peut évoluer rapidement (téléchargement en cours, liens directs)
+_SHORT_STREAM_MAX_AGE = 60
+# Liste vide des requêtes sans réponse possible (config invalide, identifiant inconnu, anime absent du dataset)
+_EMPTY_STREAMS = CachedResponse(orjson.dumps({"streams": [], **stremio_cache_hints(_SHORT_STREAM_MAX_AGE)}))
 
 
-def extract_trackers_from_magnet(magnet_uri: str) -> list:
-    try:
-        decoded_uri = html.unescape(magnet_uri)
-        parsed = urlparse(decoded_uri)
-        params = parse_qs(parsed.query)
-        return params.get("tr", [])
-    except Exception as e:
-        logger.error(f"Échec extraction trackers du magnet: {e}")
-        return []
+def _empty_streams_response(request: Request):
+    """Liste vide, servie avec les mêmes indications de cache qu'une liste construite sans flux."""
+    return cached_json_response(request, _EMPTY_STREAMS, settings.CACHE_CONTROL_STREAM)
 
 
 def _parse_media_id(media_id: str):
@@ -54,9 +52,9 @@ def _parse_media_id(media_id: str):
         return None, None
 
 async def _fetch_anime_and_episode_data(fankai_api: FankaiAPI, anime_id: str, episode_id: str, media_id: str):
-    anime_data = await get_or_fetch_anime_details(fankai_api, anime_id)
+    anime_data, stale = await get_or_fetch_anime_details(fankai_api, anime_id)
     if not anime_data:
-        return None, None
+        return None, None, False
 
     seasons = anime_data.get("seasons", [])
     videos = []
@@ -87,10 +85,10 @@ async def _fetch_anime_and_episode_data(fankai_api: FankaiAPI, anime_id: str, ep
 
     if not selected_episode:
         logger.error(f"Aucun episode trouve pour media_id: {media_id}, episode_id: {episode_id}")
-        return None, None
+        return None, None, False
         
     logger.info(f"Episode selectionne: {selected_episode.name} (S{selected_episode.season_number}E{selected_episode.number})")
-    return anime_info, selected_episode
+    return anime_info, selected_episode, stale
 
 def _create_stream_item(request: Request, b64config: str, debrid_service: str, debrid_emoji: str, torrent: dict, media_id: str, trackers: list = None, kodi: bool = False):
     file_title = torrent['title']
@@ -142,57 +140,45 @@ async def stream(request: Request, media_type: str, media_id: str, b64config: st
     """
     config = config_check(b64config)
     if not config:
-        return {"streams": []}
+        return _empty_streams_response(request)
 
     anime_id, episode_id = _parse_media_id(media_id)
     if not anime_id or not episode_id:
-        return {"streams": []}
+        return _empty_streams_response(request)
 
-    anime_info, selected_episode = await _fetch_anime_and_episode_data(fankai_api, anime_id, episode_id, media_id)
+    debrid_service = config.get("debridService", "torrent")
+    # La config encodée (qui contient la clé API) apparaît dans les URLs générées : on la hashe dans la clé
+    cache_key = (media_id, debrid_service, config.get("streamFilter", "all"), hash_secret(b64config), request.url.scheme, request.url.netloc, kodi)
+    # Version de la disponibilité lue avant la construction : une écriture concurrente, dans n'importe quel
+    # worker, rend la réponse construite ici obsolète au lieu d'être masquée
+    version = await get_cache_version(stream_version_key(media_id, debrid_service)) if debrid_service != "torrent" else None
+    cached = stream_cache.get(cache_key, version)
+    if cached is not None:
+        logger.info(f"✅ CACHE HIT: streams de {media_id} ({debrid_service})")
+        # Popularité partagée, utilisée pour prioriser le préchauffage : les réponses en cache comptent aussi
+        record_anime_request(anime_id)
+        return cached_json_response(request, cached, settings.CACHE_CONTROL_STREAM)
+
+    anime_info, selected_episode, stale = await _fetch_anime_and_episode_data(fankai_api, anime_id, episode_id, media_id)
     if not anime_info or not selected_episode:
-        return {"streams": []}
+        return _empty_streams_response(request)
     
-    dataset = request.app.state.dataset.get('top', [])
-    anime_name_norm = normalize_name(anime_info.name)
-    target_anime_data = next((item for item in dataset if str(item.get('api_id')) == anime_id), None)
-
-    # Vérifier que l'api_id a trouvé le BON anime (les IDs /series et /dataset peuvent ne pas correspondre)
-    if target_anime_data and normalize_name(target_anime_data.get('name', '')) != anime_name_norm:
-        logger.warning(f"api_id {anime_id} a trouvé '{target_anime_data.get('name')}' au lieu de '{anime_info.name}', fallback par nom")
-        target_anime_data = None
-
-    if not target_anime_data:
-        target_anime_data = next((item for item in dataset if normalize_name(item.get('name', '')) == anime_name_norm), None)
-        if target_anime_data:
-            logger.info(f"Fallback par nom: '{anime_info.name}' trouvé dans le dataset (api_id dataset: {target_anime_data.get('api_id')})")
+    target_anime_data = request.app.state.dataset_index.find_anime(anime_id, anime_info.name)
 
     if not target_anime_data:
         logger.warning(f"Anime '{anime_info.name}' (api_id: {anime_id}) non trouvé dans le dataset local.")
-        return {"streams": []}
+        return _empty_streams_response(request)
 
-    logger.info(f"Anime trouvé dans dataset: '{target_anime_data.get('name')}' pour épisode '{selected_episode.name}'")
+    logger.info(f"Anime trouvé dans dataset: '{target_anime_data.name}' pour épisode '{selected_episode.name}'")
+    record_anime_request(anime_id)
     
-    all_torrents_info = []
-    hashes_to_check = []
-    for source in target_anime_data.get('sources', []):
-        magnet = source.get('magnet')
-        info_hash_match = re.search(r'btih:([a-fA-F0-9]{40})', magnet)
-        if magnet and info_hash_match:
-            hash_val = info_hash_match.group(1).lower()
-            trackers = extract_trackers_from_magnet(magnet)
-            store_magnet_link(hash_val, magnet)
-            all_torrents_info.append({
-                "source": source,
-                "hash": hash_val,
-                "trackers": trackers
-            })
-            hashes_to_check.append(hash_val)
+    torrents = target_anime_data.torrents
+    hashes_to_check = [torrent.info_hash for torrent in torrents]
 
     if not hashes_to_check:
-        return {"streams": []}
+        return _empty_streams_response(request)
 
 
-    debrid_service = config.get("debridService", "torrent")
     status_map = {}
     if debrid_service != "torrent" and hashes_to_check:
         http_client = request.app.state.http_client
@@ -209,32 +195,32 @@ async def stream(request: Request, media_type: str, media_id: str, b64config: st
         availability_results = await debrid_instance.get_availability(hashes_to_check, seeders_map, tracker_map, sources_map)
         status_map = {result['hash']: result['status'] for result in availability_results}
 
-    streams_list = []
-    for torrent_info in all_torrents_info:
-        source = torrent_info["source"]
-        hash_val = torrent_info["hash"]
-        trackers = torrent_info.get("trackers", [])
-        files_in_torrent = source.get('files', [])
+    if not selected_episode.nfo_filename:
+        logger.warning("Aucune information d'épisode (nfo_filename) fournie pour le matching.")
+    await precompute_episode_matches(request.app.state.http_client, (target_anime_data.api_id, target_anime_data.name), torrents, [ep.nfo_filename for ep in anime_info.videos])
 
-        files_for_matching = [{"title": f} for f in files_in_torrent]
-        best_file = await find_best_file_for_episode(request.app.state.http_client, files_for_matching, selected_episode)
+    streams_list = []
+    all_cached = True
+    for torrent in torrents:
+        hash_val = torrent.info_hash
+        file_index = get_matched_file_index(hash_val, selected_episode.nfo_filename)
 
-        if best_file:
+        if file_index is not None:
+            file_title = torrent.files[file_index]
             try:
-                file_index = files_in_torrent.index(best_file['title'])
-                
                 torrent_data = {
                     'infoHash': hash_val,
-                    'title': best_file['title'],
+                    'title': file_title,
                     'fileIndex': file_index,
-                    'size': source.get('size', 0),
-                    'seeders': source.get('seeders')
+                    'size': torrent.size,
+                    'seeders': torrent.seeders
                 }
                 
                 if debrid_service == "torrent":
                     debrid_emoji = "🧲"
                 else:
                     status = status_map.get(hash_val, 'unknown')
+                    all_cached = all_cached and status == "cached"
                     if status == "cached":
                         debrid_emoji = "⚡"
                     elif status == "magnet":
@@ -244,51 +230,57 @@ async def stream(request: Request, media_type: str, media_id: str, b64config: st
                     else:
                         debrid_emoji = "❓"
                 
-                stream_item = _create_stream_item(request, b64config, debrid_service, debrid_emoji, torrent_data, media_id, trackers, kodi=kodi)
+                stream_item = _create_stream_item(request, b64config, debrid_service, debrid_emoji, torrent_data, media_id, torrent.trackers, kodi=kodi)
                 streams_list.append(stream_item)
 
 
             except (ValueError, AttributeError) as e:
-                logger.error(f"Erreur lors de la création du stream pour '{best_file['title']}': {e}")
+                logger.error(f"Erreur lors de la création du stream pour '{file_title}': {e}")
                 continue
 
     if not streams_list:
         logger.warning(f"Aucun stream n'a pu être généré pour {media_id} depuis le dataset.")
 
-    custom_sources = request.app.state.custom_sources.get('animes', [])
+    custom_sources = request.app.state.custom_sources
     logger.debug(f"Custom sources: {len(custom_sources)} anime(s) chargé(s), recherche api_id={anime_id}")
-    custom_anime = next((a for a in custom_sources if str(a.get('api_id')) == anime_id), None)
-    if not custom_anime:
-        anime_name_norm = normalize_name(anime_info.name)
-        custom_anime = next((a for a in custom_sources if normalize_name(a.get('name', '')) == anime_name_norm), None)
-
-    if custom_anime:
-        logger.debug(f"Custom anime trouvé: {custom_anime.get('name')}")
-        custom_urls = []
-        for season in custom_anime.get('seasons', []):
-            if season.get('season_number') == selected_episode.season_number:
-                for episode in season.get('episodes', []):
-                    if episode.get('episode_number') == selected_episode.number:
-                        custom_urls.extend(episode.get('urls', []))
-
-        if custom_urls:
-            scrape_tasks = [scrape_videas_url(request.app.state.http_client, url) for url in custom_urls]
-            scraped_results = await asyncio.gather(*scrape_tasks, return_exceptions=True)
-
-            for direct_url in scraped_results:
-                if direct_url and not isinstance(direct_url, Exception):
-                    custom_name = "[CUSTOM] FKStream" if kodi else "[CUSTOM ⭐] FKStream"
-                    streams_list.append({
-                        "name": custom_name,
-                        "description": f"{anime_info.name} S{(selected_episode.season_number or 0):02d}E{(selected_episode.number or 0):02d}",
-                        "url": direct_url
-                    })
-
-            added_count = sum(1 for url in scraped_results if url and not isinstance(url, Exception))
-            if added_count > 0:
-                logger.log("FKSTREAM", f"{added_count} custom source(s) ajoutée(s) pour {anime_info.name} S{(selected_episode.season_number or 0):02d}E{(selected_episode.number or 0):02d}")
-
-    return {"streams": streams_list}
+    custom_urls = custom_sources.find_urls(anime_id, anime_info.name, selected_episode.season_number, selected_episode.number)
+
+    cacheable = True
+    if custom_urls:
+        scrape_tasks = [scrape_videas_url(request.app.state.http_client, url) for url in custom_urls]
+        scraped_results = await asyncio.gather(*scrape_tasks, return_exceptions=True)
+        # Un échec de scraping ne doit pas être figé dans le cache
+        cacheable = not any(isinstance(result, Exception) for result in scraped_results)
+
+        for direct_url in scraped_results:
+            if direct_url and not isinstance(direct_url, Exception):
+                custom_name = "[CUSTOM] FKStream" if kodi else "[CUSTOM ⭐] FKStream"
+                streams_list.append({
+                    "name": custom_name,
+                    "description": f"{anime_info.name} S{(selected_episode.season_number or 0):02d}E{(selected_episode.number or 0):02d}",
+                    "url": direct_url
+                })
+
+        added_count = sum(1 for url in scraped_results if url and not isinstance(url, Exception))
+        if added_count > 0:
+            logger.log("FKSTREAM", f"{added_count} custom source(s) ajoutée(s) pour {anime_info.name} S{(selected_episode.season_number or 0):02d}E{(selected_episode.number or 0):02d}")
+
+    if stale or not streams_list or custom_urls or not all_cached:
+        max_age = _SHORT_STREAM_MAX_AGE
+    elif debrid_service == "torrent":
+        max_age = settings.METADATA_TTL
+    else:
+        max_age = min(settings.DEBRID_AVAILABILITY_TTL, settings.METADATA_TTL)
+
+    cached = CachedResponse(orjson.dumps({"streams": streams_list, **stremio_cache_hints(max_age if cacheable else 0)}))
+    if not cacheable:
+        # Résultat partiel (source en erreur) : ni cache local ni cache HTTP
+        return cached_json_response(request, cached, "no-cache")
+    if stale:
+        # Épisodes issus de métadonnées périmées, en cours de rafraîchissement : pas de cache local
+        return cached_json_response(request, cached, settings.CACHE_CONTROL_STREAM)
+    stream_cache.set(cache_key, cached, settings.STREAM_CACHE_TTL, tags=[(media_id, debrid_service)], version=version)
+    return cached_json_response(request, cached, settings.CACHE_CONTROL_STREAM)
 
 
 @stream_router.get("/{b64config}/playback/{b64_media_id}/{hash_val}/{file_index}/{filename:path}")
@@ -315,7 +307,7 @@ async def playback(request: Request, b64config: str, b64_media_id: str, hash_val
 
     #! On récupère les détails complets de l'épisode pour avoir la saison et le numéro
     fankai_api = FankaiAPI(request.app.state.http_client)
-    _, selected_episode = await _fetch_anime_and_episode_data(fankai_api, anime_id, episode_id, real_media_id)
+    _, selected_episode, _ = await _fetch_anime_and_episode_data(fankai_api, anime_id, episode_id, real_media_id)
 
     if not selected_episode:
         logger.error(f"Impossible de récupérer les détails de l'épisode pour {real_media_id}")
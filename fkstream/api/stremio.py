@@ -1,35 +1,33 @@
+import orjson
+from functools import lru_cache
 from fastapi import APIRouter, Request, Depends
-from urllib.parse import quote, urlparse, parse_qs
-from datetime import datetime
+from urllib.parse import quote
 
 from fkstream.utils.models import settings, default_config
 from fkstream.utils.config_validator import config_check
 from fkstream.debrid.manager import get_debrid_extension
 from fkstream.scrapers.fankai import FankaiAPI, get_or_fetch_anime_details
 from fkstream.utils.common_logger import logger
-from fkstream.utils.database import get_metadata_from_cache, set_metadata_to_cache
+from fkstream.utils.catalog import (
+    build_genre_links,
+    build_imdb_links,
+    extract_youtube_trailer,
+    get_series_catalog,
+    parse_genres,
+    translate_status,
+)
+from fkstream.utils.database import get_cache_version, meta_version_key, record_anime_request
 from fkstream.utils.dependencies import get_fankai_api
-from fkstream.utils.general import normalize_name
+from fkstream.utils.general import stremio_cache_hints
+from fkstream.utils.response_cache import CachedResponse, cached_json_response, meta_cache
 
 stremio_router = APIRouter(tags=["Stremio"])
 
-
-def _translate_status(status: str) -> str:
-    status_translations = {
-        "Continuing": "En cours",
-        "Ended": "Terminé",
-        "Unknown": None,
-        "Canceled": "Annulé",
-        "Cancelled": "Annulé",
-        "En suspens": "En suspens"
-    }
-    return status_translations.get(status, status)
+# Validité annoncée à Stremio pour une fiche construite sur des métadonnées en cours de rafraîchissement
+_STALE_META_MAX_AGE = 60
 
 
-def _build_genre_links(request: Request, b64config: str, genres: list) -> list:
-    if not genres:
-        return []
-    genre_links = []
+def _genre_link_prefix(request: Request, b64config: str) -> str:
     base_url = str(request.base_url).rstrip('/')
     if b64config:
         encoded_manifest = f"{base_url}/{b64config}/manifest.json"
@@ -37,65 +35,11 @@ def _build_genre_links(request: Request, b64config: str, genres: list) -> list:
         encoded_manifest = f"{base_url}/manifest.json"
 
     encoded_manifest = quote(encoded_manifest, safe='')
+    return f"stremio:///discover/{encoded_manifest}/anime/fankai_catalog?genre="
 
-    for genre_name in genres:
-        genre_links.append({
-            "name": genre_name,
-            "category": "Genres",
-            "url": f"stremio:///discover/{encoded_manifest}/anime/fankai_catalog?genre={quote(genre_name)}"
-        })
-
-    return genre_links
-
-
-def _parse_genres(genres_raw: str) -> list:
-    if not genres_raw:
-        return []
-    return [g.strip() for g in genres_raw.split(',') if g.strip()]
-
-
-def _build_imdb_links(data: dict) -> list:
-    if not data.get('imdb_id'):
-        return []
-    rating_display = str(data.get('rating_value')) if data.get('rating_value') else "N/A"
-    return [{
-        "name": rating_display,
-        "category": "imdb",
-        "url": f"https://imdb.com/title/{data.get('imdb_id')}"
-    }]
-
-
-def _extract_youtube_trailer(trailer_url: str, anime_id) -> list | None:
-    if not trailer_url:
-        logger.debug(f"TRAILER - Pas de 'trailer_url' trouve pour l'anime {anime_id}.")
-        return None
-    logger.debug(f"TRAILER - URL de bande-annonce trouvee: {trailer_url}")
-    if "youtube" in trailer_url:
-        try:
-            parsed_url = urlparse(trailer_url)
-            query_params = parse_qs(parsed_url.query)
-            video_id = query_params.get("video_id", query_params.get("v", [None]))[0]
-            if video_id:
-                trailers = [{"source": video_id, "type": "Trailer"}]
-                logger.debug(f"TRAILER - Ajout de la propriete 'trailers' au meta-objet: {trailers}")
-                return trailers
-            else:
-                logger.warning(f"TRAILER - Impossible d'extraire le video_id de l'URL: {trailer_url}")
-        except Exception as e:
-            logger.warning(f"TRAILER - Impossible de parser l'URL de la bande-annonce '{trailer_url}': {e}")
-    else:
-        logger.warning(f"TRAILER - L'URL de la bande-annonce n'est pas une URL YouTube: {trailer_url}")
-    return None
 
-
-@stremio_router.get("/manifest.json")
-@stremio_router.get("/{b64config}/manifest.json")
-async def manifest(request: Request, b64config: str = None, fankai_api: FankaiAPI = Depends(get_fankai_api)):
-    """
-    Fournit le manifeste de l'addon a Stremio.
-    Personnalise le nom et la description en fonction de la configuration.
-    """
-    base_manifest = {
+def _build_manifest() -> dict:
+    return {
         "id": settings.ADDON_ID,
         "name": settings.ADDON_NAME,
         "description": "FKStream – Addon non officiel pour accéder au contenu de Fankai",
@@ -133,49 +77,49 @@ async def manifest(request: Request, b64config: str = None, fankai_api: FankaiAP
         "behaviorHints": {"configurable": True, "configurationRequired": False},
     }
 
+
+@lru_cache(maxsize=64)
+def _render_invalid_manifest(scheme: str, netloc: str) -> CachedResponse:
+    base_manifest = _build_manifest()
+    base_manifest["name"] = "❌ | FKStream"
+    base_manifest["description"] = (
+        f"⚠️ CONFIGURATION OBSOLETE, VEUILLEZ RECONFIGURER SUR {scheme}://{netloc} ⚠️"
+    )
+    return CachedResponse(orjson.dumps(base_manifest))
+
+
+def _render_manifest(debrid_extension: str, genre_options: list[str]) -> CachedResponse:
+    base_manifest = _build_manifest()
+    base_manifest["name"] = f"{settings.ADDON_NAME}{' | ' + debrid_extension if debrid_extension else ''}"
+    base_manifest["catalogs"][0]["extra"][2]["options"] = genre_options
+    return CachedResponse(orjson.dumps(base_manifest))
+
+
+@stremio_router.get("/manifest.json")
+@stremio_router.get("/{b64config}/manifest.json")
+async def manifest(request: Request, b64config: str = None, fankai_api: FankaiAPI = Depends(get_fankai_api)):
+    """
+    Fournit le manifeste de l'addon a Stremio.
+    Personnalise le nom et la description en fonction de la configuration.
+    Le corps est pré-rendu par extension debrid et conservé avec le catalogue courant.
+    """
     config = config_check(b64config)
     if not config:
-        base_manifest["name"] = "❌ | FKStream"
-        base_manifest["description"] = (
-            f"⚠️ CONFIGURATION OBSOLETE, VEUILLEZ RECONFIGURER SUR {request.url.scheme}://{request.url.netloc} ⚠️"
-        )
-        return base_manifest
+        return cached_json_response(request, _render_invalid_manifest(request.url.scheme, request.url.netloc), settings.CACHE_CONTROL_MANIFEST)
 
     debrid_extension = get_debrid_extension(config["debridService"])
-    base_manifest["name"] = f"{settings.ADDON_NAME}{' | ' + debrid_extension if debrid_extension else ''}"
 
     try:
-        unique_genres = await extract_unique_genres(fankai_api)
-        base_manifest["catalogs"][0]["extra"][2]["options"] = unique_genres
-        logger.info(f"📋 MANIFEST - Ajout de {len(unique_genres)} options de genre")
+        catalog = await get_series_catalog(fankai_api, request.app.state.dataset_index)
     except Exception as e:
         logger.error(f"❌ MANIFEST - Echec de l'extraction des genres: {e}")
+        return cached_json_response(request, _render_manifest(debrid_extension, []), "no-cache")
 
-    return base_manifest
-
-
-async def extract_unique_genres(fankai_api: FankaiAPI) -> list[str]:
-    animes_data = await get_metadata_from_cache("fk:list")
-
-    if not animes_data:
-        logger.debug("📦 CACHE MISS: fk:list - Recuperation depuis l'API")
-        animes_data = await fankai_api.get_all_series()
-        await set_metadata_to_cache("fk:list", animes_data)
-        logger.debug("✅ CACHE SAUVEGARDE: fk:list")
-    else:
-        logger.debug("✅ CACHE HIT: fk:list")
-
-    unique_genres = set()
-    for anime in animes_data:
-        genres_raw = anime.get('genres', '')
-        if genres_raw:
-            genres = [g.strip() for g in genres_raw.split(',') if g.strip()]
-            unique_genres.update(genres)
-
-    sorted_genres = sorted(list(unique_genres))
-
-    logger.debug(f"🎭 GENRES - Extraction de {len(sorted_genres)} genres uniques depuis le cache")
-    return sorted_genres
+    cached = catalog.manifests.get(debrid_extension)
+    if cached is None:
+        cached = catalog.manifests[debrid_extension] = _render_manifest(debrid_extension, catalog.genre_options)
+        logger.info(f"📋 MANIFEST - Ajout de {len(catalog.genre_options)} options de genre")
+    return cached_json_response(request, cached, settings.CACHE_CONTROL_MANIFEST)
 
 
 @stremio_router.get("/catalog/anime/fankai_catalog.json")
@@ -188,9 +132,21 @@ async def extract_unique_genres(fankai_api: FankaiAPI) -> list[str]:
 @stremio_router.get("/{b64config}/catalog/anime/fankai_catalog/search={search}&genre={genre}.json")
 @stremio_router.get("/catalog/anime/fankai_catalog/sort={sort}.json")
 @stremio_router.get("/{b64config}/catalog/anime/fankai_catalog/sort={sort}.json")
-async def fankai_catalog(request: Request, b64config: str = None, search: str = None, genre: str = None, sort: str = None, fankai_api: FankaiAPI = Depends(get_fankai_api)):
+# Variantes paginées : déclarées en dernier pour être enregistrées en premier,
+# sinon "genre={genre}.json" capturerait "genre=Action&skip=100.json"
+@stremio_router.get("/catalog/anime/fankai_catalog/skip={skip:int}.json")
+@stremio_router.get("/{b64config}/catalog/anime/fankai_catalog/skip={skip:int}.json")
+@stremio_router.get("/catalog/anime/fankai_catalog/search={search}&skip={skip:int}.json")
+@stremio_router.get("/{b64config}/catalog/anime/fankai_catalog/search={search}&skip={skip:int}.json")
+@stremio_router.get("/catalog/anime/fankai_catalog/genre={genre}&skip={skip:int}.json")
+@stremio_router.get("/{b64config}/catalog/anime/fankai_catalog/genre={genre}&skip={skip:int}.json")
+@stremio_router.get("/catalog/anime/fankai_catalog/search={search}&genre={genre}&skip={skip:int}.json")
+@stremio_router.get("/{b64config}/catalog/anime/fankai_catalog/search={search}&genre={genre}&skip={skip:int}.json")
+@stremio_router.get("/catalog/anime/fankai_catalog/sort={sort}&skip={skip:int}.json")
+@stremio_router.get("/{b64config}/catalog/anime/fankai_catalog/sort={sort}&skip={skip:int}.json")
+async def fankai_catalog(request: Request, b64config: str = None, search: str = None, genre: str = None, sort: str = None, skip: int = None, fankai_api: FankaiAPI = Depends(get_fankai_api)):
     """
-    Fournit le catalogue d'animes en filtrant par le dataset local.
+    Fournit le catalogue d'animes en filtrant par le dataset local, par pages de CATALOG_PAGE_SIZE.
     """
     if not search and "search" in request.query_params:
         search = request.query_params.get("search")
@@ -198,30 +154,27 @@ async def fankai_catalog(request: Request, b64config: str = None, search: str =
         genre = request.query_params.get("genre")
     if not sort and "sort" in request.query_params:
         sort = request.query_params.get("sort")
+    if skip is None and request.query_params.get("skip", "").isdigit():
+        skip = int(request.query_params["skip"])
+    skip = skip or 0
 
-    logger.info(f"🔍 CATALOG - Catalogue Fankai demandé, recherche: {search}, genre: {genre}, tri: {sort}")
+    logger.info(f"🔍 CATALOG - Catalogue Fankai demandé, recherche: {search}, genre: {genre}, tri: {sort}, skip: {skip}")
 
-    # 1. Obtenir la liste des api_id et noms autorisés depuis le dataset
-    dataset_animes = request.app.state.dataset.get('top', [])
-    available_api_ids = {str(anime.get('api_id')) for anime in dataset_animes}
-    available_names_norm = {normalize_name(anime.get('name', '')) for anime in dataset_animes}
+    dataset_index = request.app.state.dataset_index
 
-    if not dataset_animes:
+    if not len(dataset_index):
         logger.warning("Le dataset est vide. Le catalogue sera vide.")
         return {"metas": []}
 
-    animes_data = await get_metadata_from_cache("fk:list")
-
-    if animes_data:
-        logger.debug("✅ CACHE HIT: fk:list")
-    else:
-        logger.debug("📦 CACHE MISS: fk:list - Recuperation depuis l'API")
-        animes_data = await fankai_api.get_all_series()
-        await set_metadata_to_cache("fk:list", animes_data)
+    # Liste fk:list filtrée par le dataset, pré-triée pour chaque clé de tri
+    catalog = await get_series_catalog(fankai_api, dataset_index)
 
-    # 2. Filtrer la liste d'animes : par api_id d'abord, fallback par nom normalisé
-    animes_data = [anime for anime in animes_data if str(anime.get('id')) in available_api_ids or normalize_name(anime.get('title', '')) in available_names_norm]
-    logger.info(f"Filtrage par dataset : {len(animes_data)} animes valides à traiter.")
+    # Le préfixe des liens contient la config encodée, qui détermine aussi le tri par défaut
+    genre_link_prefix = _genre_link_prefix(request, b64config)
+    page_key = (genre_link_prefix, search, genre, sort, skip)
+    cached = catalog.get_page(page_key)
+    if cached is not None:
+        return cached_json_response(request, cached, settings.CACHE_CONTROL_CATALOG)
 
     config = config_check(b64config)
     if not config:
@@ -239,57 +192,10 @@ async def fankai_catalog(request: Request, b64config: str = None, search: str =
 
     logger.info(f"Tri du catalogue par: {sort_by}")
 
-    def get_sort_value(anime, key):
-        val = anime.get(key)
-        if val is None:
-            if key in ['rating_value', 'year']: return -1
-            if key == 'last_update': return datetime.min
-            return ""
-        if key in ['rating_value', 'year']:
-            try: return float(val)
-            except (ValueError, TypeError): return -1
-        if key == 'last_update':
-            try: return datetime.fromisoformat(str(val).replace(" ", "T"))
-            except (ValueError, TypeError): return datetime.min
-        return val
-
-    reverse = sort_by != 'title'
-    animes_data.sort(key=lambda x: get_sort_value(x, sort_by), reverse=reverse)
-
-    metas = []
-    for anime in animes_data:
-        anime_title = anime.get('title', '')
-        genres = _parse_genres(anime.get('genres', ''))
-
-        if search and search.lower() not in anime_title.lower():
-            continue
-
-        if genre and genre not in genres:
-            continue
-
-        genre_links = _build_genre_links(request, b64config, genres)
-        imdb_links = _build_imdb_links(anime)
-
-        meta = {
-            "id": f"fk:{anime.get('id')}",
-            "type": "anime",
-            "logo": anime.get('logo_image'),
-            "name": anime_title,
-            "poster": anime.get('poster_image'),
-            "posterShape": "poster",
-            "genres": genres,
-            "imdbRating": str(anime.get('rating_value')) if anime.get('rating_value') else None,
-            "releaseInfo": str(anime.get('year')) if anime.get('year') else None,
-            "runtime": _translate_status(anime.get('status')) if anime.get('status') else None,
-            "imdb_id": anime.get('imdb_id'),
-            "description": anime.get('plot', '') or "Aucune description disponible",
-            "links": genre_links + imdb_links,
-        }
-
-        trailers = _extract_youtube_trailer(anime.get("trailer_url"), anime.get('id'))
-        if trailers:
-            meta['trailers'] = trailers
-        metas.append(meta)
+    if search:
+        metas = catalog.search(search, sort_by, genre_link_prefix, genre)
+    else:
+        metas = catalog.view(sort_by, genre_link_prefix, genre)
 
     if search and genre:
         logger.info(f"🔍 CATALOG - Recherche '{search}' + Genre '{genre}': {len(metas)} animes trouves")
@@ -300,7 +206,13 @@ async def fankai_catalog(request: Request, b64config: str = None, search: str =
     else:
         logger.info(f"🔍 CATALOG - Retour de tous les {len(metas)} animes valides")
 
-    return {"metas": metas}
+    if settings.CATALOG_PAGE_SIZE and settings.CATALOG_PAGE_SIZE > 0:
+        metas = metas[skip:skip + settings.CATALOG_PAGE_SIZE]
+        logger.debug(f"📄 CATALOG - Page skip={skip}: {len(metas)} animes")
+
+    body = orjson.dumps({"metas": metas, **stremio_cache_hints(settings.METADATA_TTL)})
+    cached = catalog.set_page(page_key, CachedResponse(body))
+    return cached_json_response(request, cached, settings.CACHE_CONTROL_CATALOG)
 
 
 def _validate_anime_id(anime_id: str) -> bool:
@@ -328,10 +240,24 @@ async def fankai_meta(request: Request, id: str, b64config: str = None, fankai_a
         logger.warning(f"ID d'anime invalide (non numerique ou hors plage 1-999999): {anime_id}")
         return {"meta": {}}
 
-    anime_data = await get_or_fetch_anime_details(fankai_api, anime_id)
+    # Le préfixe des liens de genre contient la config encodée, qui détermine aussi maxActorsDisplay
+    genre_link_prefix = _genre_link_prefix(request, b64config)
+    cache_key = (id, genre_link_prefix)
+    # Version des métadonnées lue avant la construction : une écriture faite par un autre worker
+    # (préchauffage, rafraîchissement) écarte les fiches en cache et les copies mémoire antérieures
+    version = await get_cache_version(meta_version_key(id))
+    cached = meta_cache.get(cache_key, version)
+    if cached is not None:
+        logger.debug(f"✅ CACHE HIT: meta {id}")
+        # Popularité partagée, utilisée pour prioriser le préchauffage : les réponses en cache comptent aussi
+        record_anime_request(anime_id)
+        return cached_json_response(request, cached, settings.CACHE_CONTROL_META)
+
+    anime_data, stale = await get_or_fetch_anime_details(fankai_api, anime_id, version)
 
     if not anime_data:
         return {"meta": {}}
+    record_anime_request(anime_id)
 
     logger.debug(f"ANIME_DATA KEYS - Cles disponibles pour l'anime {anime_id}: {list(anime_data.keys())}")
 
@@ -345,7 +271,7 @@ async def fankai_meta(request: Request, id: str, b64config: str = None, fankai_a
         "background": anime_data.get('fanart_image'),
         "imdbRating": str(anime_data.get('rating_value')) if anime_data.get('rating_value') else None,
         "releaseInfo": str(anime_data.get('year')) if anime_data.get('year') else None,
-        "runtime": _translate_status(anime_data.get('status')) if anime_data.get('status') else None,
+        "runtime": translate_status(anime_data.get('status')) if anime_data.get('status') else None,
         "imdb_id": anime_data.get('imdb_id'),
         "description": anime_data.get('plot'),
         "behaviorHints": {
@@ -355,7 +281,7 @@ async def fankai_meta(request: Request, id: str, b64config: str = None, fankai_a
 
     videos = []
 
-    trailers = _extract_youtube_trailer(anime_data.get("trailer_url"), anime_id)
+    trailers = extract_youtube_trailer(anime_data.get("trailer_url"), anime_id)
     if trailers:
         meta['trailers'] = trailers
 
@@ -395,11 +321,11 @@ async def fankai_meta(request: Request, id: str, b64config: str = None, fankai_a
     if season_images:
         meta['seasonImages'] = season_images
 
-    genres = _parse_genres(anime_data.get('genres', ''))
+    genres = parse_genres(anime_data.get('genres', ''))
     meta['genres'] = genres
 
-    genre_links = _build_genre_links(request, b64config, genres)
-    imdb_links = _build_imdb_links(anime_data)
+    genre_links = build_genre_links(genre_link_prefix, genres)
+    imdb_links = build_imdb_links(anime_data)
 
     actor_links = []
     actors = anime_data.get('actors', [])
@@ -418,4 +344,10 @@ async def fankai_meta(request: Request, id: str, b64config: str = None, fankai_a
 
     meta['links'] = genre_links + imdb_links + actor_links
 
-    return {"meta": meta}
+    if stale:
+        # Métadonnées périmées en cours de rafraîchissement : validité courte, ni cache local ni cache HTTP
+        cached = CachedResponse(orjson.dumps({"meta": meta, **stremio_cache_hints(_STALE_META_MAX_AGE)}))
+        return cached_json_response(request, cached, "no-cache")
+    cached = CachedResponse(orjson.dumps({"meta": meta, **stremio_cache_hints(settings.METADATA_TTL)}))
+    meta_cache.set(cache_key, cached, settings.META_CACHE_TTL, tags=[id], version=version)
+    return cached_json_response(request, cached, settings.CACHE_CONTROL_META)
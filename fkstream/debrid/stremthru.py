@@ -6,7 +6,7 @@ from RTN import parse
 from fkstream.utils.models import settings, Episode
 from fkstream.utils.general import is_video
 from fkstream.utils.stream_utils import find_best_file_for_episode
-from fkstream.utils.database import get_debrid_from_cache, save_debrid_to_cache
+from fkstream.utils.database import get_debrid_from_cache, get_debrid_statuses_from_cache, save_debrid_to_cache, save_debrid_statuses_to_cache
 from fkstream.utils.common_logger import logger
 from fkstream.utils.magnet_store import get_magnet_link
 from fkstream.utils.http_client import HttpClient
@@ -97,16 +97,15 @@ class StremThru:
 
         cached_files, unknown_hashes = [], []
 
-        cache_tasks = [
-            get_debrid_from_cache(self.sid, hash, self.real_debrid_name) 
-            for hash in torrent_hashes
-        ]
-        cache_results = await asyncio.gather(*cache_tasks, return_exceptions=True)
+        try:
+            cached_statuses = await get_debrid_statuses_from_cache(self.sid, torrent_hashes, self.real_debrid_name)
+        except Exception as e:
+            logger.warning(f"Echec de la lecture groupee du cache de disponibilite: {e}")
+            cached_statuses = {}
 
-        for i, hash in enumerate(torrent_hashes):
-            cached_status = cache_results[i]
-            if cached_status and not isinstance(cached_status, Exception):
-                status = cached_status["status"]
+        for hash in torrent_hashes:
+            if hash in cached_statuses:
+                status = cached_statuses[hash]
                 logger.info(f"✅ CACHE HIT: {hash} = {status}")
                 cached_files.append({"hash": hash, "status": status, "title": "", "size": 0})
             else:
@@ -124,7 +123,7 @@ class StremThru:
             for file_list in processed_files_list:
                 if file_list: newly_processed_files.extend(file_list)
 
-            cache_save_tasks = []
+            statuses_to_save = {}
             for file_info in newly_processed_files:
                 hash = file_info["hash"]
                 api_status = file_info.get("status", "unknown")
@@ -134,12 +133,15 @@ class StremThru:
                         logger.info(f"⏩ Sauvegarde du cache ignoree pour media_id de type playback_filename: {self.sid}")
                         file_info["status"] = db_status
                         continue
-                    cache_save_tasks.append(save_debrid_to_cache(self.sid, hash, self.real_debrid_name, db_status))
+                    statuses_to_save[hash] = db_status
                     logger.info(f"💾 ECRITURE BD: {hash} → {db_status}")
                 file_info["status"] = db_status or "unknown"
             
-            if cache_save_tasks:
-                await asyncio.gather(*cache_save_tasks, return_exceptions=True)
+            if statuses_to_save:
+                try:
+                    await save_debrid_statuses_to_cache(self.sid, statuses_to_save, self.real_debrid_name)
+                except Exception as e:
+                    logger.warning(f"Echec de l'ecriture groupee du cache de disponibilite: {e}")
 
         final_files = cached_files + newly_processed_files
         logger.log("SCRAPER", f"{self.name}: Trouve {len(final_files)} fichiers valides au total ({len(cached_files)} en cache, {len(newly_processed_files)} nouveaux).")
@@ -262,7 +264,7 @@ class StremThru:
             # Utiliser la même fonction que stream.py pour uniformité
             fankai_api = FankaiAPI(self.session)
             
-            anime_data = await get_or_fetch_anime_details(fankai_api, anime_id)
+            anime_data, _ = await get_or_fetch_anime_details(fankai_api, anime_id)
             if not anime_data:
                 logger.warning(f"❌ StremThru: Impossible de récupérer les métadonnées pour {anime_id}")
                 return None
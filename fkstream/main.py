@@ -4,7 +4,6 @@ import time
 import uvicorn
 import os
 import asyncio
-import orjson
 from contextlib import asynccontextmanager, contextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
@@ -22,10 +21,19 @@ from fkstream.utils.database import (
     teardown_database,
     cleanup_expired_locks,
     cleanup_expired_kodi_codes,
+    periodic_anime_requests_flush,
 )
 from fkstream.utils.http_client import HttpClient
+from fkstream.utils.dataset import (
+    DatasetIndex,
+    install_dataset_index,
+    load_dataset_snapshot,
+    periodic_dataset_update,
+    refresh_dataset,
+)
 from fkstream.utils.common_logger import logger
 from fkstream.utils.models import settings
+from fkstream.utils.metadata_warmer import periodic_metadata_warmup
 from fkstream.utils.custom_sources import (
     download_custom_sources,
     periodic_custom_source_update,
@@ -74,18 +82,18 @@ async def lifespan(app: FastAPI):
         app.state.http_client = HttpClient()
         logger.info("Client HTTP initialisé avec succès")
 
-        try:
-            response = await app.state.http_client.get(
-                f"{settings.FANKAI_URL}/dataset",
-                headers={"X-Dataset-API-Key": settings.API_KEY}
-            )
-            response.raise_for_status()
-            app.state.dataset = orjson.loads(response.content)
-            logger.log("FKSTREAM", "Dataset chargé avec succès depuis l'API.")
-        except Exception as e:
-            logger.error(f"Impossible de charger le dataset depuis l'API: {e}")
-            app.state.dataset = {"top": []}
-            raise RuntimeError(f"Échec du chargement du dataset: {e}")
+        # Le snapshot local permet un démarrage immédiat (et hors ligne), l'API est interrogée ensuite en arrière-plan
+        snapshot_index = await load_dataset_snapshot()
+        if snapshot_index is not None:
+            install_dataset_index(app.state, snapshot_index)
+        else:
+            try:
+                # Un seul worker télécharge le dataset, les autres projettent le snapshot qu'il publie
+                await refresh_dataset(app.state.http_client, app.state)
+            except Exception as e:
+                logger.error(f"Impossible de charger le dataset depuis l'API: {e}")
+                install_dataset_index(app.state, DatasetIndex())
+                raise RuntimeError(f"Échec du chargement du dataset: {e}")
 
         if settings.CUSTOM_SOURCE_URL:
             app.state.custom_sources = await download_custom_sources(app.state.http_client)
@@ -99,23 +107,43 @@ async def lifespan(app: FastAPI):
 
     cleanup_task = asyncio.create_task(cleanup_expired_locks())
     kodi_cleanup_task = asyncio.create_task(cleanup_expired_kodi_codes())
+    anime_requests_task = asyncio.create_task(periodic_anime_requests_flush())
     custom_source_task = None
     if settings.CUSTOM_SOURCE_URL:
         custom_source_task = asyncio.create_task(
             periodic_custom_source_update(app.state.http_client, app.state)
         )
+    dataset_task = None
+    if snapshot_index is not None or settings.DATASET_REFRESH_INTERVAL > 0:
+        dataset_task = asyncio.create_task(
+            periodic_dataset_update(
+                app.state.http_client, app.state, initial_delay=0 if snapshot_index is not None else None
+            )
+        )
+    warmer_task = None
+    if settings.METADATA_WARMER_INTERVAL > 0:
+        warmer_task = asyncio.create_task(periodic_metadata_warmup(app.state.http_client, app.state))
 
     try:
         yield
     finally:
         cleanup_task.cancel()
         kodi_cleanup_task.cancel()
+        anime_requests_task.cancel()
         if custom_source_task:
             custom_source_task.cancel()
+        if dataset_task:
+            dataset_task.cancel()
+        if warmer_task:
+            warmer_task.cancel()
 
-        tasks = [cleanup_task, kodi_cleanup_task]
+        tasks = [cleanup_task, kodi_cleanup_task, anime_requests_task]
         if custom_source_task:
             tasks.append(custom_source_task)
+        if dataset_task:
+            tasks.append(dataset_task)
+        if warmer_task:
+            tasks.append(warmer_task)
 
         try:
             await asyncio.gather(*tasks, return_exceptions=True)
@@ -222,6 +250,7 @@ def start_log():
         "FKSTREAM",
         f"Base de donnees ({settings.DATABASE_TYPE}): {db_display} - TTL: metadata={settings.METADATA_TTL}s, debrid={settings.DEBRID_AVAILABILITY_TTL}s",
     )
+    logger.log("FKSTREAM", f"Rafraichissement du dataset: {f'toutes les {settings.DATASET_REFRESH_INTERVAL}s' if settings.DATASET_REFRESH_INTERVAL > 0 else 'desactive'}")
     logger.log("FKSTREAM", f"Proxy Debrid: {settings.DEBRID_PROXY_URL}")
     logger.log(
         "FKSTREAM",
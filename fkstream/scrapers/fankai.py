@@ -1,11 +1,12 @@
 import asyncio
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 
 from fkstream.utils.http_client import HttpClient
-from fkstream.utils.database import get_metadata_from_cache, set_metadata_to_cache, DistributedLock, LockAcquisitionError
+from fkstream.utils.database import get_metadata_from_cache, get_stale_metadata_from_cache, set_metadata_to_cache, DistributedLock, LockAcquisitionError
 from fkstream.utils.common_logger import logger
 from fkstream.utils.base_client import BaseClient
 from fkstream.utils.models import settings
+from fkstream.utils.response_cache import meta_cache
 
 
 async def _fetch_complete_anime_data(fankai_api: "FankaiAPI", anime_id: str) -> dict:
@@ -85,39 +86,73 @@ class FankaiAPI(BaseClient):
             return []
 
 
-async def get_or_fetch_anime_details(fankai_api: "FankaiAPI", anime_id: str) -> Optional[Dict[str, Any]]:
+# Rafraîchissements de métadonnées en arrière-plan, un seul par anime et par processus
+_background_refreshes: Dict[str, asyncio.Task] = {}
+
+
+async def _refresh_anime_details(fankai_api: "FankaiAPI", anime_id: str) -> None:
+    media_id = f"fk:{anime_id}"
+    try:
+        async with DistributedLock(f"metadata_fetch_{anime_id}"):
+            if await get_metadata_from_cache(media_id):
+                # Déjà rafraîchie par un autre worker : les metas construites ici sur l'entrée périmée sont obsolètes
+                meta_cache.invalidate(media_id)
+                return
+            anime_data = await _fetch_complete_anime_data(fankai_api, anime_id)
+            if anime_data:
+                await set_metadata_to_cache(media_id, anime_data)
+                logger.info(f"🔄 Metadonnees rafraichies en arriere-plan: {media_id}")
+    except LockAcquisitionError:
+        logger.debug(f"Rafraichissement de {media_id} deja en cours sur une autre instance.")
+    except Exception as e:
+        logger.warning(f"Echec du rafraichissement en arriere-plan de {media_id}: {e}")
+    finally:
+        _background_refreshes.pop(anime_id, None)
+
+
+async def get_or_fetch_anime_details(fankai_api: "FankaiAPI", anime_id: str, version: Optional[str] = None) -> Tuple[Optional[Dict[str, Any]], bool]:
     """
     Obtient les détails d'un anime depuis le cache si disponible, sinon les récupère
     depuis l'API Fankai, gère le verrouillage pour éviter les conditions de concurrence,
     et met le résultat en cache.
+    Une entrée expirée depuis moins de METADATA_STALE_TTL est servie immédiatement et rafraîchie en arrière-plan.
+    Retourne (détails, périmés) : les réponses construites sur des détails périmés ne doivent pas être mises en cache.
+    version (lue dans cache_version) écarte une copie mémoire antérieure à la dernière écriture, faite par n'importe quel worker.
     """
     media_id = f"fk:{anime_id}"
-    cached_anime = await get_metadata_from_cache(media_id)
+    cached_anime = await get_metadata_from_cache(media_id, version)
 
     if cached_anime:
         logger.info(f"✅ CACHE HIT: {media_id}")
-        return cached_anime
+        return cached_anime, False
+
+    stale_anime = await get_stale_metadata_from_cache(media_id)
+    if stale_anime:
+        if anime_id not in _background_refreshes:
+            _background_refreshes[anime_id] = asyncio.create_task(_refresh_anime_details(fankai_api, anime_id))
+        logger.info(f"♻️ CACHE STALE: {media_id} - Rafraichissement en arriere-plan")
+        return stale_anime, True
 
     lock_key = f"metadata_fetch_{anime_id}"
     try:
         async with DistributedLock(lock_key):
-            cached_anime = await get_metadata_from_cache(media_id)
+            cached_anime = await get_metadata_from_cache(media_id, version)
             if cached_anime:
                 logger.info(f"✅ CACHE HIT apres verrou: {media_id}")
-                return cached_anime
+                return cached_anime, False
 
             logger.info(f"📦 CACHE MISS: {media_id} - Recuperation depuis l'API avec verrou")
             anime_data = await _fetch_complete_anime_data(fankai_api, anime_id)
             if anime_data:
                 await set_metadata_to_cache(media_id, anime_data)
-            return anime_data
+            return anime_data, False
             
     except LockAcquisitionError:
         logger.warning(f"Impossible d'acquerir le verrou de metadonnees pour {anime_id}, nouvelle tentative sans verrou.")
         anime_data = await _fetch_complete_anime_data(fankai_api, anime_id)
         if anime_data:
             await set_metadata_to_cache(media_id, anime_data)
-        return anime_data
+        return anime_data, False
     except Exception as e:
         logger.error(f"Une erreur inattendue s'est produite lors de la recuperation des details de l'anime pour {anime_id}: {e}")
-        return None
+        return None, False
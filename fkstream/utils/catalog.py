@@ -0,0 +1,353 @@
+import time
+import asyncio
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from datetime import datetime
+from typing import Optional
+from urllib.parse import quote, urlparse, parse_qs
+
+from fkstream.utils.common_logger import logger
+from fkstream.utils.database import get_versioned_metadata, set_metadata_to_cache
+from fkstream.utils.general import fold_text, normalize_name
+from fkstream.utils.response_cache import CachedResponse
+
+SORT_KEYS = ("last_update", "rating_value", "title", "year")
+
+# Délai entre deux vérifications de la version de fk:list en base
+_CATALOG_CHECK_INTERVAL = 60
+# Nombre de préfixes de liens de genre (URL du manifeste) dont les vues rendues sont conservées
+_RENDERED_VIEWS_MAX = 64
+# Nombre de pages de catalogue sérialisées conservées (recherches comprises)
+_RENDERED_PAGES_MAX = 1024
+# Part minimale des trigrammes de la recherche présents dans un titre pour une correspondance approchée
+_FUZZY_MIN_CONTAINMENT = 0.6
+
+
+def translate_status(status: str) -> str:
+    status_translations = {
+        "Continuing": "En cours",
+        "Ended": "Terminé",
+        "Unknown": None,
+        "Canceled": "Annulé",
+        "Cancelled": "Annulé",
+        "En suspens": "En suspens"
+    }
+    return status_translations.get(status, status)
+
+
+def parse_genres(genres_raw: str) -> list:
+    if not genres_raw:
+        return []
+    return [g.strip() for g in genres_raw.split(',') if g.strip()]
+
+
+def build_imdb_links(data: dict) -> list:
+    if not data.get('imdb_id'):
+        return []
+    rating_display = str(data.get('rating_value')) if data.get('rating_value') else "N/A"
+    return [{
+        "name": rating_display,
+        "category": "imdb",
+        "url": f"https://imdb.com/title/{data.get('imdb_id')}"
+    }]
+
+
+def extract_youtube_trailer(trailer_url: str, anime_id) -> list | None:
+    if not trailer_url:
+        logger.debug(f"TRAILER - Pas de 'trailer_url' trouve pour l'anime {anime_id}.")
+        return None
+    logger.debug(f"TRAILER - URL de bande-annonce trouvee: {trailer_url}")
+    if "youtube" in trailer_url:
+        try:
+            parsed_url = urlparse(trailer_url)
+            query_params = parse_qs(parsed_url.query)
+            video_id = query_params.get("video_id", query_params.get("v", [None]))[0]
+            if video_id:
+                trailers = [{"source": video_id, "type": "Trailer"}]
+                logger.debug(f"TRAILER - Ajout de la propriete 'trailers' au meta-objet: {trailers}")
+                return trailers
+            else:
+                logger.warning(f"TRAILER - Impossible d'extraire le video_id de l'URL: {trailer_url}")
+        except Exception as e:
+            logger.warning(f"TRAILER - Impossible de parser l'URL de la bande-annonce '{trailer_url}': {e}")
+    else:
+        logger.warning(f"TRAILER - L'URL de la bande-annonce n'est pas une URL YouTube: {trailer_url}")
+    return None
+
+
+def build_genre_links(genre_link_prefix: str, genres: list) -> list:
+    return [{
+        "name": genre_name,
+        "category": "Genres",
+        "url": f"{genre_link_prefix}{quote(genre_name)}"
+    } for genre_name in genres]
+
+
+def _sort_value(anime: dict, key: str):
+    val = anime.get(key)
+    if val is None:
+        if key in ['rating_value', 'year']: return -1
+        if key == 'last_update': return datetime.min
+        return ""
+    if key in ['rating_value', 'year']:
+        try: return float(val)
+        except (ValueError, TypeError): return -1
+    if key == 'last_update':
+        try: return datetime.fromisoformat(str(val).replace(" ", "T"))
+        except (ValueError, TypeError): return datetime.min
+    return val
+
+
+def _trigrams(text: str) -> set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+    """
+    Index de recherche des titres, insensible aux accents et à la casse (fold_text).
+    Combine un index inversé par trigrammes et la liste triée des mots pour retrouver, par score
+    décroissant : titre exact, début de titre, mots commençant par chaque terme, sous-chaîne,
+    puis, à défaut, les titres approchants (fautes de frappe).
+    """
+
+    def __init__(self, names_per_item: list[list[str]]):
+        self._names: list[tuple[str, ...]] = []
+        self._trigram_counts: list[int] = []
+        self._postings: dict[str, set[int]] = {}
+        words = []
+
+        for item, names in enumerate(names_per_item):
+            folded_names = tuple(dict.fromkeys(folded for folded in map(fold_text, names) if folded))
+            trigrams = set()
+            for folded in folded_names:
+                trigrams |= _trigrams(folded)
+                words.extend((word, item) for word in folded.split())
+            for trigram in trigrams:
+                self._postings.setdefault(trigram, set()).add(item)
+            self._names.append(folded_names)
+            self._trigram_counts.append(len(trigrams))
+
+        words.sort()
+        self._words = [word for word, _ in words]
+        self._word_items = [item for _, item in words]
+
+    def _items_with_word_prefix(self, prefix: str) -> set[int]:
+        start = bisect_left(self._words, prefix)
+        end = bisect_left(self._words, prefix + "\uffff", start)
+        return set(self._word_items[start:end])
+
+    def search(self, query: str) -> dict[int, float]:
+        """Retourne {position: score} des éléments correspondant à la recherche."""
+        query = fold_text(query)
+        if not query:
+            return {}
+        scores: dict[int, float] = {}
+
+        # Sous-chaîne : seuls les éléments contenant tous les trigrammes de la recherche sont vérifiés
+        if len(query) >= 3:
+            postings = sorted((self._postings.get(query[i:i + 3], set()) for i in range(len(query) - 2)), key=len)
+            candidates = postings[0].intersection(*postings[1:])
+        else:
+            candidates = range(len(self._names))
+        for item in candidates:
+            for name in self._names[item]:
+                if name == query:
+                    score = 4.0
+                elif name.startswith(query):
+                    score = 3.0
+                elif query in name:
+                    score = 2.0
+                else:
+                    continue
+                scores[item] = max(scores.get(item, 0.0), score)
+
+        # Préfixes de mots : chaque terme de la recherche commence un mot du titre
+        prefix_matches = [self._items_with_word_prefix(token) for token in query.split()]
+        for item in set.intersection(*prefix_matches):
+            scores[item] = max(scores.get(item, 0.0), 2.5)
+
+        if scores:
+            return scores
+
+        # Correspondance approchée : part des trigrammes partagés, classée par similarité de Jaccard
+        query_trigrams = _trigrams(query)
+        shared = Counter()
+        for trigram in query_trigrams:
+            shared.update(self._postings.get(trigram, ()))
+        for item, count in shared.items():
+            if count / len(query_trigrams) >= _FUZZY_MIN_CONTAINMENT:
+                scores[item] = count / (len(query_trigrams) + self._trigram_counts[item] - count)
+        return scores
+
+
+def _build_catalog_meta(anime: dict, genres: list) -> dict:
+    """Meta du catalogue, sans les liens de genre qui dépendent de l'URL du manifeste."""
+    anime_title = anime.get('title', '')
+    meta = {
+        "id": f"fk:{anime.get('id')}",
+        "type": "anime",
+        "logo": anime.get('logo_image'),
+        "name": anime_title,
+        "poster": anime.get('poster_image'),
+        "posterShape": "poster",
+        "genres": genres,
+        "imdbRating": str(anime.get('rating_value')) if anime.get('rating_value') else None,
+        "releaseInfo": str(anime.get('year')) if anime.get('year') else None,
+        "runtime": translate_status(anime.get('status')) if anime.get('status') else None,
+        "imdb_id": anime.get('imdb_id'),
+        "description": anime.get('plot', '') or "Aucune description disponible",
+        "links": None,
+    }
+    trailers = extract_youtube_trailer(anime.get("trailer_url"), anime.get('id'))
+    if trailers:
+        meta['trailers'] = trailers
+    return meta
+
+
+class SeriesCatalog:
+    """
+    Catalogue matérialisé : la liste fk:list filtrée par le dataset, ses metas construites une fois
+    et une vue pré-triée (positions) par clé de tri. Reconstruit uniquement lorsque fk:list ou le dataset change.
+    """
+
+    def __init__(self, animes_data: list, dataset_index, list_version: Optional[str]):
+        self.dataset_index = dataset_index
+        self.list_version = list_version
+        self.checked_at = time.monotonic()
+
+        self.animes = [
+            anime for anime in animes_data
+            if dataset_index.contains(str(anime.get('id')), normalize_name(anime.get('title', '')))
+        ]
+        self.genres = [parse_genres(anime.get('genres', '')) for anime in self.animes]
+        self.metas = [_build_catalog_meta(anime, genres) for anime, genres in zip(self.animes, self.genres)]
+        self.imdb_links = [build_imdb_links(anime) for anime in self.animes]
+        self.views = {}
+        self.view_ranks = {}
+        for key in SORT_KEYS:
+            sort_values = [_sort_value(anime, key) for anime in self.animes]
+            self.views[key] = sorted(range(len(self.animes)), key=sort_values.__getitem__, reverse=key != 'title')
+            ranks = [0] * len(self.animes)
+            for rank, position in enumerate(self.views[key]):
+                ranks[position] = rank
+            self.view_ranks[key] = ranks
+        self.search_index = SearchIndex([[anime.get('title', '')] for anime in self.animes])
+
+        # Index inversé genre -> positions, et liste des genres du manifeste (sur toute la liste fk:list)
+        self.genre_postings: dict[str, frozenset[int]] = {}
+        for position, genres in enumerate(self.genres):
+            for genre in genres:
+                self.genre_postings.setdefault(genre, set()).add(position)
+        self.genre_postings = {genre: frozenset(positions) for genre, positions in self.genre_postings.items()}
+        self.genre_options = sorted({genre for anime in animes_data for genre in parse_genres(anime.get('genres', ''))})
+        # Par préfixe de lien de genre : metas rendues par position, puis vues rendues par (tri, genre)
+        self._rendered: OrderedDict[str, tuple[list, dict]] = OrderedDict()
+        # Manifestes pré-rendus par extension debrid, reconstruits avec le catalogue
+        self.manifests: dict[str, CachedResponse] = {}
+        # Pages de catalogue sérialisées, par (préfixe, recherche, genre, tri, skip)
+        self._pages: OrderedDict[tuple, CachedResponse] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.animes)
+
+    def _render(self, genre_link_prefix: str) -> tuple[list, dict]:
+        rendered = self._rendered.get(genre_link_prefix)
+        if rendered is None:
+            by_position = [
+                {**meta, "links": build_genre_links(genre_link_prefix, genres) + imdb_links}
+                for meta, genres, imdb_links in zip(self.metas, self.genres, self.imdb_links)
+            ]
+            rendered = self._rendered[genre_link_prefix] = (by_position, {})
+            while len(self._rendered) > _RENDERED_VIEWS_MAX:
+                self._rendered.popitem(last=False)
+        else:
+            self._rendered.move_to_end(genre_link_prefix)
+        return rendered
+
+    def get_page(self, key: tuple) -> Optional[CachedResponse]:
+        cached = self._pages.get(key)
+        if cached is not None:
+            self._pages.move_to_end(key)
+        return cached
+
+    def set_page(self, key: tuple, cached: CachedResponse) -> CachedResponse:
+        self._pages[key] = cached
+        while len(self._pages) > _RENDERED_PAGES_MAX:
+            self._pages.popitem(last=False)
+        return cached
+
+    def view(self, sort_by: str, genre_link_prefix: str, genre: Optional[str] = None) -> list[dict]:
+        """
+        Metas complètes triées par sort_by, éventuellement restreintes à un genre.
+        La liste retournée est partagée et ne doit pas être modifiée.
+        """
+        sort_by = sort_by if sort_by in self.views else "last_update"
+        by_position, sorted_views = self._render(genre_link_prefix)
+        metas = sorted_views.get((sort_by, genre))
+        if metas is None:
+            if genre:
+                ranks = self.view_ranks[sort_by]
+                positions = sorted(self.genre_postings.get(genre, ()), key=ranks.__getitem__)
+            else:
+                positions = self.views[sort_by]
+            metas = sorted_views[(sort_by, genre)] = [by_position[position] for position in positions]
+        return metas
+
+    def search(self, query: str, sort_by: str, genre_link_prefix: str, genre: Optional[str] = None) -> list[dict]:
+        """Metas correspondant à la recherche (et au genre), par pertinence puis selon sort_by."""
+        sort_by = sort_by if sort_by in self.views else "last_update"
+        scores = self.search_index.search(query)
+        positions = scores.keys() & self.genre_postings.get(genre, frozenset()) if genre else scores.keys()
+        ranks = self.view_ranks[sort_by]
+        by_position, _ = self._render(genre_link_prefix)
+        return [by_position[position] for position in sorted(positions, key=lambda position: (-scores[position], ranks[position]))]
+
+
+_catalog: Optional[SeriesCatalog] = None
+_catalog_lock = asyncio.Lock()
+
+
+async def get_series_list(fankai_api, known_version: Optional[str] = None) -> tuple[Optional[str], Optional[list]]:
+    """
+    Retourne (version, liste des séries) lus ensemble en base, ou depuis l'API si fk:list est absent.
+    La liste vaut None lorsque sa version est known_version. Le cache mémoire n'est pas utilisé :
+    sa copie, propre au worker, peut être plus ancienne que la version lue.
+    """
+    list_version, animes_data = await get_versioned_metadata("fk:list", known_version)
+    if list_version is not None and (animes_data or list_version == known_version):
+        logger.debug("✅ CACHE HIT: fk:list")
+        return list_version, animes_data
+    logger.debug("📦 CACHE MISS: fk:list - Recuperation depuis l'API")
+    animes_data = await fankai_api.get_all_series()
+    return await set_metadata_to_cache("fk:list", animes_data), animes_data
+
+
+async def get_series_catalog(fankai_api, dataset_index) -> SeriesCatalog:
+    """
+    Retourne le catalogue matérialisé courant. La version de fk:list en base n'est vérifiée
+    qu'une fois par _CATALOG_CHECK_INTERVAL ; un changement de dataset force la reconstruction.
+    """
+    global _catalog
+
+    catalog = _catalog
+    if catalog is not None and catalog.dataset_index is dataset_index and time.monotonic() - catalog.checked_at < _CATALOG_CHECK_INTERVAL:
+        return catalog
+
+    async with _catalog_lock:
+        catalog = _catalog
+        reusable = catalog is not None and catalog.dataset_index is dataset_index
+        if reusable and time.monotonic() - catalog.checked_at < _CATALOG_CHECK_INTERVAL:
+            return catalog
+
+        list_version, animes_data = await get_series_list(fankai_api, catalog.list_version if reusable else None)
+        if animes_data is None:
+            catalog.checked_at = time.monotonic()
+            return catalog
+
+        start_time = time.perf_counter()
+        catalog = SeriesCatalog(animes_data, dataset_index, list_version)
+        _catalog = catalog
+        logger.info(f"Filtrage par dataset : {len(catalog)} animes valides à traiter.")
+        logger.log("FKSTREAM", f"Catalogue reconstruit: {len(catalog)} animes, {len(SORT_KEYS)} vues triées en {time.perf_counter() - start_time:.3f}s")
+        return catalog
@@ -4,13 +4,50 @@ import os
 from pathlib import Path
 
 from fkstream.utils.common_logger import logger
+from fkstream.utils.general import normalize_name
 from fkstream.utils.models import settings
-
-
-async def download_custom_sources(http_client):
+from fkstream.utils.response_cache import stream_cache
+
+
+class CustomSourceIndex:
+    """
+    Index des sources personnalisées, construit une fois par chargement du fichier.
+    Les URLs sont indexées par (anime, saison, épisode) ; l'anime est retrouvé par api_id
+    puis, à défaut, par nom normalisé (la première entrée l'emporte, comme pour une recherche linéaire).
+    """
+
+    def __init__(self, data: dict):
+        self.by_api_id: dict[str, int] = {}
+        self.by_name: dict[str, int] = {}
+        self.by_episode: dict[tuple, list[str]] = {}
+        self.names: list[str] = []
+
+        for position, anime in enumerate(data.get("animes", [])):
+            self.names.append(anime.get("name", ""))
+            self.by_api_id.setdefault(str(anime.get("api_id")), position)
+            self.by_name.setdefault(normalize_name(anime.get("name", "")), position)
+            for season in anime.get("seasons", []):
+                for episode in season.get("episodes", []):
+                    key = (position, season.get("season_number"), episode.get("episode_number"))
+                    self.by_episode.setdefault(key, []).extend(episode.get("urls", []))
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def find_urls(self, anime_id: str, anime_name: str, season_number, episode_number) -> list[str]:
+        position = self.by_api_id.get(anime_id)
+        if position is None:
+            position = self.by_name.get(normalize_name(anime_name))
+        if position is None:
+            return []
+        logger.debug(f"Custom anime trouvé: {self.names[position]}")
+        return self.by_episode.get((position, season_number, episode_number), [])
+
+
+async def download_custom_sources(http_client) -> CustomSourceIndex:
     if not settings.CUSTOM_SOURCE_URL:
         logger.log("FKSTREAM", "CUSTOM_SOURCE_URL non configuré, pas de téléchargement")
-        return {"animes": []}
+        return CustomSourceIndex({"animes": []})
 
     try:
         logger.log("FKSTREAM", f"Téléchargement de custom_sources depuis {settings.CUSTOM_SOURCE_URL}")
@@ -29,7 +66,7 @@ async def download_custom_sources(http_client):
         anime_count = len(data.get('animes', []))
         logger.log("FKSTREAM", f"Custom sources téléchargées et sauvegardées: {anime_count} anime(s)")
 
-        return data
+        return CustomSourceIndex(data)
     except Exception as e:
         logger.error(f"Erreur lors du téléchargement de custom_sources: {e}")
 
@@ -37,11 +74,11 @@ async def download_custom_sources(http_client):
             logger.log("FKSTREAM", "Utilisation du fichier custom_sources en cache")
             try:
                 with open(settings.CUSTOM_SOURCE_PATH, 'rb') as f:
-                    return orjson.loads(f.read())
+                    return CustomSourceIndex(orjson.loads(f.read()))
             except Exception as e2:
                 logger.error(f"Erreur lors de la lecture du cache custom_sources: {e2}")
 
-        return {"animes": []}
+        return CustomSourceIndex({"animes": []})
 
 
 async def periodic_custom_source_update(http_client, app_state):
@@ -50,8 +87,9 @@ async def periodic_custom_source_update(http_client, app_state):
             await asyncio.sleep(settings.CUSTOM_SOURCE_INTERVAL)
 
             logger.log("FKSTREAM", "Mise à jour périodique de custom_sources")
-            data = await download_custom_sources(http_client)
-            app_state.custom_sources = data
+            # L'index est entièrement construit avant d'être publié
+            app_state.custom_sources = await download_custom_sources(http_client)
+            stream_cache.clear()
 
         except asyncio.CancelledError:
             logger.log("FKSTREAM", "Tâche de mise à jour custom_sources annulée")
@@ -60,15 +98,15 @@ async def periodic_custom_source_update(http_client, app_state):
             logger.error(f"Erreur dans la tâche périodique custom_sources: {e}")
 
 
-def load_custom_sources_from_cache():
+def load_custom_sources_from_cache() -> CustomSourceIndex:
     if os.path.exists(settings.CUSTOM_SOURCE_PATH):
         try:
             with open(settings.CUSTOM_SOURCE_PATH, 'rb') as f:
                 data = orjson.loads(f.read())
             anime_count = len(data.get('animes', []))
             logger.log("FKSTREAM", f"Custom sources chargées depuis le cache: {anime_count} anime(s)")
-            return data
+            return CustomSourceIndex(data)
         except Exception as e:
             logger.error(f"Erreur lors de la lecture du cache custom_sources: {e}")
 
-    return {"animes": []}
+    return CustomSourceIndex({"animes": []})
@@ -2,10 +2,22 @@ import os
 import time
 import json
 import asyncio
+import hashlib
 import uuid
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import asyncpg
+
+try:
+    import fcntl
+except ImportError:  # Windows : DistributedLock se replie sur la table scrape_lock
+    fcntl = None
 
 from fkstream.utils.common_logger import logger
 from fkstream.utils.models import database, settings
+from fkstream.utils.response_cache import meta_cache, stream_cache
 
 DATABASE_VERSION = "1.2"
 
@@ -29,7 +41,7 @@ async def setup_database():
             logger.log("FKSTREAM", f"Base de donnees: Migration de la version {current_version} a {DATABASE_VERSION}")
 
             if settings.DATABASE_TYPE == "sqlite":
-                allowed_tables = {'scrape_lock', 'metadata', 'debrid_availability', 'kodi_setup_codes'}
+                allowed_tables = {'scrape_lock', 'metadata', 'debrid_availability', 'kodi_setup_codes', 'cache_version', 'anime_popularity'}
                 tables = await database.fetch_all("SELECT name FROM sqlite_master WHERE type='table' AND name NOT IN ('db_version', 'sqlite_sequence')")
                 for table in tables:
                     table_name = table['name']
@@ -62,6 +74,8 @@ async def setup_database():
         await database.execute("CREATE TABLE IF NOT EXISTS debrid_availability (media_id TEXT NOT NULL, hash TEXT NOT NULL, debrid_service TEXT NOT NULL, status TEXT NOT NULL, timestamp REAL NOT NULL, expires_at REAL, PRIMARY KEY (media_id, hash, debrid_service))")
         await database.execute("CREATE TABLE IF NOT EXISTS custom_source (page_url TEXT PRIMARY KEY, direct_url TEXT NOT NULL, timestamp REAL NOT NULL, expires_at REAL NOT NULL)")
         await database.execute("CREATE TABLE IF NOT EXISTS kodi_setup_codes (code TEXT PRIMARY KEY, nonce TEXT NOT NULL, b64config TEXT, created_at REAL NOT NULL, expires_at REAL NOT NULL, consumed_at REAL)")
+        await database.execute("CREATE TABLE IF NOT EXISTS cache_version (cache_key TEXT PRIMARY KEY, version TEXT NOT NULL)")
+        await database.execute("CREATE TABLE IF NOT EXISTS anime_popularity (anime_id TEXT PRIMARY KEY, request_count INTEGER NOT NULL)")
 
         await database.execute("CREATE INDEX IF NOT EXISTS idx_custom_source_expires ON custom_source(expires_at)")
         await database.execute("CREATE INDEX IF NOT EXISTS idx_kodi_expires ON kodi_setup_codes(expires_at)")
@@ -76,7 +90,8 @@ async def setup_database():
 
         current_time = time.time()
         cleanup_tasks = [
-            database.execute("DELETE FROM metadata WHERE expires_at IS NOT NULL AND expires_at < :current_time;", {"current_time": current_time}),
+            # Les métadonnées expirées restent servables pendant METADATA_STALE_TTL, le temps d'être rafraîchies
+            database.execute("DELETE FROM metadata WHERE expires_at IS NOT NULL AND expires_at < :stale_limit;", {"stale_limit": current_time - (settings.METADATA_STALE_TTL or 0)}),
             database.execute("DELETE FROM debrid_availability WHERE expires_at IS NOT NULL AND expires_at < :current_time;", {"current_time": current_time}),
             database.execute("DELETE FROM custom_source WHERE expires_at < :current_time;", {"current_time": current_time}),
             database.execute("DELETE FROM kodi_setup_codes WHERE expires_at < :current_time;", {"current_time": current_time}),
@@ -98,10 +113,95 @@ async def cleanup_expired_locks():
         await asyncio.sleep(60)
 
 
-async def get_metadata_from_cache(media_id: str):
+class MetadataMemoryCache:
+    """
+    Cache LRU en mémoire, propre au processus, des métadonnées déjà décodées.
+    Borné par la taille cumulée des JSON d'origine ; une entrée ne survit ni à son TTL local ni à l'expiration en base.
+    Chaque entrée garde la version (empreinte) de son contenu, pour être écartée dès qu'une version plus récente est connue.
+    Les objets retournés sont partagés et ne doivent pas être modifiés.
+    """
+
+    def __init__(self, max_bytes: int, ttl: int):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._store: OrderedDict[str, tuple[float, int, object, str]] = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, media_id: str, version: str = None):
+        entry = self._store.get(media_id)
+        if entry is None or entry[0] <= time.time() or (version is not None and entry[3] != version):
+            if entry is not None:
+                self.discard(media_id)
+            self.misses += 1
+            return None
+        self._store.move_to_end(media_id)
+        self.hits += 1
+        return entry[2]
+
+    def set(self, media_id: str, value, size: int, expires_at: float, version: str) -> None:
+        self.discard(media_id)
+        if self.ttl <= 0 or size > self.max_bytes:
+            return
+        self._store[media_id] = (min(expires_at, time.time() + self.ttl), size, value, version)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (_, evicted_size, _, _) = self._store.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def discard(self, media_id: str) -> None:
+        entry = self._store.pop(media_id, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._store),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+metadata_memory_cache = MetadataMemoryCache(
+    max_bytes=(settings.METADATA_MEMORY_CACHE_MAX_MB or 0) * 1024 * 1024,
+    ttl=settings.METADATA_MEMORY_CACHE_TTL or 0,
+)
+
+
+async def get_metadata_from_cache(media_id: str, version: str = None):
+    """
+    Entrée valide, depuis le cache mémoire puis la base, ou None.
+    Si version est donnée (lue dans cache_version), une copie mémoire d'une autre version est relue en base.
+    """
+    cached = metadata_memory_cache.get(media_id, version)
+    if cached is not None:
+        return cached
+
     current_time = time.time()
-    query = "SELECT media_data FROM metadata WHERE media_id = :media_id AND expires_at > :current_time"
+    query = "SELECT media_data, expires_at FROM metadata WHERE media_id = :media_id AND expires_at > :current_time"
     result = await database.fetch_one(query, {"media_id": media_id, "current_time": current_time})
+    if not result or not result["media_data"]:
+        return None
+    try:
+        data = json.loads(result["media_data"])
+    except json.JSONDecodeError:
+        return None
+    metadata_memory_cache.set(media_id, data, len(result["media_data"]), result["expires_at"], _metadata_version(result["media_data"]))
+    return data
+
+
+async def get_stale_metadata_from_cache(media_id: str):
+    """Entrée expirée depuis moins de METADATA_STALE_TTL, servie pendant que son rafraîchissement est en cours."""
+    if not settings.METADATA_STALE_TTL or settings.METADATA_STALE_TTL <= 0:
+        return None
+    query = "SELECT media_data FROM metadata WHERE media_id = :media_id AND expires_at > :stale_limit"
+    result = await database.fetch_one(query, {"media_id": media_id, "stale_limit": time.time() - settings.METADATA_STALE_TTL})
     if not result or not result["media_data"]:
         return None
     try:
@@ -110,15 +210,93 @@ async def get_metadata_from_cache(media_id: str):
         return None
 
 
-async def set_metadata_to_cache(media_id: str, data, ttl: int = None):
+async def get_metadata_entry(media_id: str):
+    """Entrée de métadonnées et sa date d'expiration, même expirée, ou None si absente ou illisible."""
+    result = await database.fetch_one("SELECT media_data, expires_at FROM metadata WHERE media_id = :media_id", {"media_id": media_id})
+    if not result or not result["media_data"]:
+        return None
+    try:
+        return json.loads(result["media_data"]), result["expires_at"] or 0
+    except json.JSONDecodeError:
+        return None
+
+
+async def extend_metadata_ttl(media_id: str, ttl: int = None):
+    """Prolonge une entrée inchangée sans la réécrire."""
+    expires_at = time.time() + (ttl if ttl is not None else settings.METADATA_TTL)
+    await database.execute("UPDATE metadata SET expires_at = :expires_at WHERE media_id = :media_id", {"media_id": media_id, "expires_at": expires_at})
+
+
+def _metadata_version(media_data: str) -> str:
+    return hashlib.blake2b(media_data.encode(), digest_size=16).hexdigest()
+
+
+async def get_versioned_metadata(media_id: str, known_version: str = None):
+    """
+    Lit une entrée valide directement en base, sans le cache mémoire, avec sa version : l'empreinte
+    de son contenu (la colonne timestamp, REAL, n'est pas assez précise sous PostgreSQL).
+    Retourne (version, données) ; les données valent None si l'entrée est absente ou illisible,
+    ou si sa version est known_version (le contenu n'est alors pas décodé).
+    """
+    query = "SELECT media_data, expires_at FROM metadata WHERE media_id = :media_id AND expires_at > :current_time"
+    result = await database.fetch_one(query, {"media_id": media_id, "current_time": time.time()})
+    if not result or not result["media_data"]:
+        return None, None
+    version = _metadata_version(result["media_data"])
+    if version == known_version:
+        return version, None
+    try:
+        data = json.loads(result["media_data"])
+    except json.JSONDecodeError:
+        return None, None
+    metadata_memory_cache.set(media_id, data, len(result["media_data"]), result["expires_at"], version)
+    return version, data
+
+
+async def set_metadata_to_cache(media_id: str, data, ttl: int = None) -> str:
+    """Enregistre une entrée de métadonnées et retourne sa version."""
     current_time = time.time()
     expires_at = current_time + (ttl if ttl is not None else settings.METADATA_TTL)
     if settings.DATABASE_TYPE == "sqlite":
         query = "INSERT OR REPLACE INTO metadata (media_id, media_data, timestamp, expires_at) VALUES (:media_id, :media_data, :timestamp, :expires_at)"
     else:
         query = "INSERT INTO metadata (media_id, media_data, timestamp, expires_at) VALUES (:media_id, :media_data, :timestamp, :expires_at) ON CONFLICT (media_id) DO UPDATE SET media_data = :media_data, timestamp = :timestamp, expires_at = :expires_at"
-    values = {"media_id": media_id, "media_data": json.dumps(data), "timestamp": current_time, "expires_at": expires_at}
+    media_data = json.dumps(data)
+    values = {"media_id": media_id, "media_data": media_data, "timestamp": current_time, "expires_at": expires_at}
     await database.execute(query, values)
+    version = _metadata_version(media_data)
+    metadata_memory_cache.set(media_id, data, len(media_data), expires_at, version)
+    # Écrite après l'entrée : les autres workers écartent alors leurs metas et leur copie mémoire de l'ancienne
+    await set_cache_version(meta_version_key(media_id), version)
+    meta_cache.invalidate(media_id)
+    return version
+
+
+async def get_cache_version(cache_key: str) -> Optional[str]:
+    """
+    Version courante d'un contenu dont dépendent des réponses en cache, partagée entre workers,
+    ou None s'il n'a jamais été modifié.
+    """
+    return await database.fetch_val("SELECT version FROM cache_version WHERE cache_key = :cache_key", {"cache_key": cache_key})
+
+
+async def set_cache_version(cache_key: str, version: str = None) -> None:
+    """Change la version d'un contenu : tous les workers ignorent alors les réponses construites sur l'ancienne."""
+    if settings.DATABASE_TYPE == "sqlite":
+        query = "INSERT OR REPLACE INTO cache_version (cache_key, version) VALUES (:cache_key, :version)"
+    else:
+        query = "INSERT INTO cache_version (cache_key, version) VALUES (:cache_key, :version) ON CONFLICT (cache_key) DO UPDATE SET version = :version"
+    await database.execute(query, {"cache_key": cache_key, "version": version or uuid.uuid4().hex})
+
+
+def stream_version_key(media_id: str, debrid_service: str) -> str:
+    """Clé de version des réponses /stream d'un épisode pour un service debrid."""
+    return f"stream:{debrid_service}:{media_id}"
+
+
+def meta_version_key(media_id: str) -> str:
+    """Clé de version des métadonnées d'une entrée : l'empreinte de son contenu."""
+    return f"meta:{media_id}"
 
 
 async def get_debrid_from_cache(media_id: str, hash: str, debrid_service: str):
@@ -138,6 +316,138 @@ async def save_debrid_to_cache(media_id: str, hash: str, debrid_service: str, st
         query = "INSERT INTO debrid_availability (media_id, hash, debrid_service, status, timestamp, expires_at) VALUES (:media_id, :hash, :debrid_service, :status, :timestamp, :expires_at) ON CONFLICT (media_id, hash, debrid_service) DO UPDATE SET status = :status, timestamp = :timestamp, expires_at = :expires_at"
     values = {"media_id": media_id, "hash": hash, "debrid_service": debrid_service, "status": status, "timestamp": current_time, "expires_at": expires_at}
     await database.execute(query, values)
+    # La disponibilité a changé : les réponses /stream déjà construites pour cet épisode sont obsolètes,
+    # ici et dans les autres workers
+    await set_cache_version(stream_version_key(media_id, debrid_service))
+    stream_cache.invalidate((media_id, debrid_service))
+
+
+# Nombre de hashes par requête groupée sous PostgreSQL, où chaque tranche est passée en tableaux
+_BULK_CHUNK_SIZE = 500
+# Limite de variables par requête des SQLite antérieurs à 3.32. databases passe les paramètres nommés
+# en positionnels : chaque occurrence d'un paramètre dans la requête compte pour une variable.
+_SQLITE_MAX_VARIABLES = 999
+
+
+def _bulk_chunk_size(variables_per_row: int, fixed_variables: int = 0) -> int:
+    """Nombre de lignes par requête groupée, borné sous SQLite par _SQLITE_MAX_VARIABLES."""
+    if settings.DATABASE_TYPE == "sqlite":
+        return (_SQLITE_MAX_VARIABLES - fixed_variables) // variables_per_row
+    return _BULK_CHUNK_SIZE
+
+
+async def get_debrid_statuses_from_cache(media_id: str, hashes: list, debrid_service: str) -> dict:
+    """Statuts en cache de plusieurs hashes en une requête (par tranche) : {hash: status}."""
+    statuses = {}
+    current_time = time.time()
+    # Une variable par hash, plus media_id, debrid_service et current_time
+    chunk_size = _bulk_chunk_size(1, fixed_variables=3)
+    for start in range(0, len(hashes), chunk_size):
+        chunk = hashes[start:start + chunk_size]
+        values = {"media_id": media_id, "debrid_service": debrid_service, "current_time": current_time}
+        if settings.DATABASE_TYPE == "sqlite":
+            values.update({f"hash_{i}": hash for i, hash in enumerate(chunk)})
+            hash_condition = f"hash IN ({', '.join(f':hash_{i}' for i in range(len(chunk)))})"
+        else:
+            values["hashes"] = list(chunk)
+            hash_condition = "hash = ANY(CAST(:hashes AS TEXT[]))"
+        query = f"SELECT hash, status FROM debrid_availability WHERE media_id = :media_id AND debrid_service = :debrid_service AND {hash_condition} AND (expires_at IS NULL OR expires_at > :current_time)"
+        for row in await database.fetch_all(query, values):
+            statuses[row["hash"]] = row["status"]
+    return statuses
+
+
+async def save_debrid_statuses_to_cache(media_id: str, statuses: dict, debrid_service: str):
+    """Enregistre {hash: status} en un upsert multi-lignes (par tranche)."""
+    if not statuses:
+        return
+    current_time = time.time()
+    expires_at = current_time + settings.DEBRID_AVAILABILITY_TTL
+    items = list(statuses.items())
+    # Six variables par ligne insérée : les paramètres communs sont répétés dans chaque ligne
+    chunk_size = _bulk_chunk_size(6)
+    for start in range(0, len(items), chunk_size):
+        chunk = items[start:start + chunk_size]
+        values = {"media_id": media_id, "debrid_service": debrid_service, "timestamp": current_time, "expires_at": expires_at}
+        if settings.DATABASE_TYPE == "sqlite":
+            rows = []
+            for i, (hash, status) in enumerate(chunk):
+                values[f"hash_{i}"] = hash
+                values[f"status_{i}"] = status
+                rows.append(f"(:media_id, :hash_{i}, :debrid_service, :status_{i}, :timestamp, :expires_at)")
+            query = f"INSERT OR REPLACE INTO debrid_availability (media_id, hash, debrid_service, status, timestamp, expires_at) VALUES {', '.join(rows)}"
+        else:
+            values["hashes"] = [hash for hash, _ in chunk]
+            values["statuses"] = [status for _, status in chunk]
+            query = (
+                "INSERT INTO debrid_availability (media_id, hash, debrid_service, status, timestamp, expires_at) "
+                "SELECT CAST(:media_id AS TEXT), t.hash, CAST(:debrid_service AS TEXT), t.status, CAST(:timestamp AS REAL), CAST(:expires_at AS REAL) "
+                "FROM UNNEST(CAST(:hashes AS TEXT[]), CAST(:statuses AS TEXT[])) AS t(hash, status) "
+                "ON CONFLICT (media_id, hash, debrid_service) DO UPDATE SET status = EXCLUDED.status, timestamp = EXCLUDED.timestamp, expires_at = EXCLUDED.expires_at"
+            )
+        await database.execute(query, values)
+    await set_cache_version(stream_version_key(media_id, debrid_service))
+    stream_cache.invalidate((media_id, debrid_service))
+
+
+# Demandes par anime pas encore reportées dans anime_popularity, écrites par lots à chaque intervalle
+_pending_anime_requests: Counter = Counter()
+_ANIME_REQUESTS_FLUSH_INTERVAL = 60
+
+
+def record_anime_request(anime_id: str) -> None:
+    """Compte une demande (meta ou stream) pour un anime, réponse en cache comprise."""
+    _pending_anime_requests[anime_id] += 1
+
+
+async def flush_anime_requests() -> None:
+    """Ajoute les demandes en attente aux compteurs partagés par tous les workers et instances."""
+    if not _pending_anime_requests:
+        return
+    pending = list(_pending_anime_requests.items())
+    _pending_anime_requests.clear()
+    try:
+        chunk_size = _bulk_chunk_size(2)
+        while pending:
+            chunk = pending[:chunk_size]
+            if settings.DATABASE_TYPE == "sqlite":
+                values = {}
+                rows = []
+                for i, (anime_id, count) in enumerate(chunk):
+                    values[f"anime_id_{i}"] = anime_id
+                    values[f"count_{i}"] = count
+                    rows.append(f"(:anime_id_{i}, :count_{i})")
+                query = (
+                    f"INSERT INTO anime_popularity (anime_id, request_count) VALUES {', '.join(rows)} "
+                    "ON CONFLICT (anime_id) DO UPDATE SET request_count = request_count + excluded.request_count"
+                )
+            else:
+                values = {"anime_ids": [anime_id for anime_id, _ in chunk], "counts": [count for _, count in chunk]}
+                query = (
+                    "INSERT INTO anime_popularity (anime_id, request_count) "
+                    "SELECT t.anime_id, t.request_count FROM UNNEST(CAST(:anime_ids AS TEXT[]), CAST(:counts AS INTEGER[])) AS t(anime_id, request_count) "
+                    "ON CONFLICT (anime_id) DO UPDATE SET request_count = anime_popularity.request_count + EXCLUDED.request_count"
+                )
+            await database.execute(query, values)
+            del pending[:chunk_size]
+    finally:
+        # Demandes non écrites (erreur, annulation) : conservées pour le prochain lot
+        _pending_anime_requests.update(dict(pending))
+
+
+async def get_anime_request_counts() -> dict:
+    """Nombre de demandes par anime, tous workers confondus : {anime_id: nombre}."""
+    rows = await database.fetch_all("SELECT anime_id, request_count FROM anime_popularity")
+    return {row["anime_id"]: row["request_count"] for row in rows}
+
+
+async def periodic_anime_requests_flush():
+    while True:
+        await asyncio.sleep(_ANIME_REQUESTS_FLUSH_INTERVAL)
+        try:
+            await flush_anime_requests()
+        except Exception as e:
+            logger.warning(f"Echec de l'enregistrement des demandes par anime: {e}")
 
 
 async def get_custom_source_from_cache(page_url: str):
@@ -207,32 +517,272 @@ async def release_lock(lock_key: str, instance_id: str) -> bool:
         return False
 
 
+class _LocalLock:
+    """Verrou asyncio partagé par les coroutines du processus attendant la même clé."""
+
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+# Une seule coroutine par clé et par processus dispute le verrou inter-processus ; les autres attendent localement
+_local_locks: dict[str, _LocalLock] = {}
+# Threads dédiés aux attentes flock bloquantes, pour ne pas occuper l'exécuteur par défaut
+_lock_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="fkstream-lock")
+
+
+def _advisory_key(lock_key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(lock_key.encode(), digest_size=8).digest(), "big", signed=True)
+
+
+# Canal NOTIFY signalant la libération d'un verrou consultatif PostgreSQL
+_ADVISORY_CHANNEL = "fkstream_lock_released"
+# Nouvelle tentative périodique : un verrou rendu par la fin de la session qui le détenait n'est pas notifié
+_ADVISORY_RETRY_INTERVAL = 5
+
+
+class _AdvisoryLockSession:
+    """
+    Connexion PostgreSQL dédiée, hors du pool, qui porte les verrous consultatifs du processus.
+    Les prises se font sans attente (pg_try_advisory_lock) ; chaque libération est notifiée (NOTIFY)
+    aux processus en attente, qui retentent alors la prise. Aucune connexion du pool n'est occupée
+    pendant la détention ou l'attente d'un verrou. Si la connexion est perdue, ses verrous disparaissent avec elle.
+    """
+
+    def __init__(self):
+        self._connection: Optional[asyncpg.Connection] = None
+        self._mutex = asyncio.Lock()
+        self._waiters: dict[int, set[asyncio.Event]] = {}
+
+    async def _ensure_connection(self) -> asyncpg.Connection:
+        if self._connection is None or self._connection.is_closed():
+            self._connection = await asyncpg.connect(f"postgresql://{settings.DATABASE_URL}")
+            await self._connection.add_listener(_ADVISORY_CHANNEL, self._on_release)
+        return self._connection
+
+    def _on_release(self, connection, pid, channel, payload) -> None:
+        for event in self._waiters.get(int(payload), ()):
+            event.set()
+
+    def watch(self, key: int, event: asyncio.Event) -> None:
+        self._waiters.setdefault(key, set()).add(event)
+
+    def unwatch(self, key: int, event: asyncio.Event) -> None:
+        events = self._waiters.get(key)
+        if events is not None:
+            events.discard(event)
+            if not events:
+                del self._waiters[key]
+
+    async def _try_lock(self, key: int) -> bool:
+        async with self._mutex:
+            connection = await self._ensure_connection()
+            return await connection.fetchval("SELECT pg_try_advisory_lock($1)", key)
+
+    async def try_lock(self, key: int) -> bool:
+        attempt = asyncio.ensure_future(self._try_lock(key))
+        try:
+            return await asyncio.shield(attempt)
+        except asyncio.CancelledError:
+            # La prise a pu aboutir côté serveur : le verrou est rendu dès qu'elle se termine
+            def _release_if_acquired(done):
+                if not done.cancelled() and done.exception() is None and done.result():
+                    asyncio.ensure_future(self.unlock(key))
+            attempt.add_done_callback(_release_if_acquired)
+            raise
+
+    async def unlock(self, key: int) -> None:
+        async with self._mutex:
+            connection = self._connection
+            if connection is None or connection.is_closed():
+                return
+            await connection.execute("SELECT pg_advisory_unlock($1), pg_notify($2, $3)", key, _ADVISORY_CHANNEL, str(key))
+
+    async def close(self) -> None:
+        async with self._mutex:
+            if self._connection is not None and not self._connection.is_closed():
+                await self._connection.close()
+            self._connection = None
+
+
+_advisory_session = _AdvisoryLockSession()
+
+
+def _lock_file_path(lock_key: str) -> str:
+    directory = os.path.join(os.path.dirname(settings.DATABASE_PATH) or ".", "locks")
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{hashlib.sha1(lock_key.encode()).hexdigest()}.lock")
+
+
+def _release_file_lock(fd: int) -> None:
+    try:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def _release_file_lock_when_acquired(future: asyncio.Future, fd: int) -> None:
+    """Un flock encore en attente dans son thread ne peut être interrompu : il est rendu dès qu'il aboutit."""
+    def _done(done_future):
+        if done_future.cancelled() or done_future.exception() is not None:
+            os.close(fd)
+        else:
+            _release_file_lock(fd)
+    future.add_done_callback(_done)
+
+
 class DistributedLock:
-    def __init__(self, lock_key: str, instance_id: str = None, duration: int = None):
+    """
+    Verrou exclusif par clé, partagé entre coroutines, workers et instances.
+    - dans un processus : asyncio.Lock par clé, les attentes sont réveillées dès la libération ;
+    - PostgreSQL : verrou consultatif sur une connexion dédiée (voir _AdvisoryLockSession), l'attente est réveillée par NOTIFY ;
+    - SQLite : flock sur un fichier par clé à côté de la base, le noyau réveille l'attente à la libération ;
+    - sans fcntl (Windows) : repli sur la table scrape_lock, interrogée chaque seconde.
+    Les verrous consultatifs et flock disparaissent avec le processus qui les détient ; duration ne sert qu'au repli.
+    Un timeout de 0 tente l'acquisition une seule fois sans attendre.
+    """
+
+    def __init__(self, lock_key: str, instance_id: str = None, duration: int = None, timeout: float = None):
         self.lock_key = lock_key
         self.instance_id = instance_id or f"fkstream_{uuid.uuid4().hex[:12]}"
         self.duration = duration if duration is not None else settings.SCRAPE_LOCK_TTL
+        self.timeout = timeout if timeout is not None else settings.SCRAPE_WAIT_TIMEOUT
         self.acquired = False
-    
+        self._local: Optional[_LocalLock] = None
+        self._advisory_key: Optional[int] = None
+        self._fd: Optional[int] = None
+
     async def __aenter__(self):
         start_time = time.time()
-        timeout = settings.SCRAPE_WAIT_TIMEOUT
-        
-        while time.time() - start_time < timeout:
-            self.acquired = await acquire_lock(self.lock_key, self.instance_id, self.duration)
-            if self.acquired:
-                logger.log("LOCK", f"✅ Verrou acquis pour {self.lock_key} apres {time.time() - start_time:.2f}s d'attente.")
-                return self
-            
-            logger.log("LOCK", f"⏳ Attente du verrou {self.lock_key}...")
-            await asyncio.sleep(1)
-            
-        raise LockAcquisitionError(f"Impossible d'acquerir le verrou {self.lock_key} apres {timeout}s")
+        local = self._local = _local_locks.setdefault(self.lock_key, _LocalLock())
+        local.users += 1
+        try:
+            if self.timeout <= 0:
+                if local.lock.locked():
+                    raise LockAcquisitionError(f"Verrou {self.lock_key} deja detenu")
+                await local.lock.acquire()
+            else:
+                await asyncio.wait_for(local.lock.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self._forget_local()
+            raise LockAcquisitionError(f"Impossible d'acquerir le verrou {self.lock_key} apres {self.timeout}s")
+        except BaseException:
+            self._forget_local()
+            raise
+
+        try:
+            await self._acquire_shared(max(0.0, self.timeout - (time.time() - start_time)) if self.timeout > 0 else 0)
+        except BaseException:
+            local.lock.release()
+            self._forget_local()
+            raise
+
+        self.acquired = True
+        logger.log("LOCK", f"✅ Verrou acquis pour {self.lock_key} apres {time.time() - start_time:.2f}s d'attente.")
+        return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if self.acquired:
+        if not self.acquired:
+            return
+        self.acquired = False
+        try:
+            await self._release_shared()
+        finally:
+            self._local.lock.release()
+            self._forget_local()
+
+    def _forget_local(self) -> None:
+        local = self._local
+        local.users -= 1
+        if local.users == 0 and _local_locks.get(self.lock_key) is local:
+            del _local_locks[self.lock_key]
+
+    async def _acquire_shared(self, timeout: float) -> None:
+        if settings.DATABASE_TYPE != "sqlite":
+            await self._acquire_advisory(timeout)
+        elif fcntl is not None:
+            await self._acquire_file(timeout)
+        else:
+            await self._acquire_polling(timeout)
+
+    async def _release_shared(self) -> None:
+        if self._advisory_key is not None:
+            key, self._advisory_key = self._advisory_key, None
+            # Une annulation pendant la libération ne doit pas laisser le verrou détenu
+            await asyncio.shield(_advisory_session.unlock(key))
+        elif self._fd is not None:
+            fd, self._fd = self._fd, None
+            _release_file_lock(fd)
+        else:
             await release_lock(self.lock_key, self.instance_id)
 
+    async def _acquire_advisory(self, timeout: float) -> None:
+        key = _advisory_key(self.lock_key)
+        deadline = time.monotonic() + timeout
+        released = asyncio.Event()
+        _advisory_session.watch(key, released)
+        try:
+            while True:
+                released.clear()
+                if await _advisory_session.try_lock(key):
+                    break
+                if timeout <= 0:
+                    raise LockAcquisitionError(f"Verrou {self.lock_key} deja detenu")
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise LockAcquisitionError(f"Impossible d'acquerir le verrou {self.lock_key} apres {timeout:.0f}s")
+                logger.log("LOCK", f"⏳ Attente du verrou {self.lock_key}...")
+                try:
+                    await asyncio.wait_for(released.wait(), min(remaining, _ADVISORY_RETRY_INTERVAL))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            _advisory_session.unwatch(key, released)
+        self._advisory_key = key
+
+    async def _acquire_file(self, timeout: float) -> None:
+        fd = os.open(_lock_file_path(self.lock_key), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self._fd = fd
+            return
+        except BlockingIOError:
+            if timeout <= 0:
+                os.close(fd)
+                raise LockAcquisitionError(f"Verrou {self.lock_key} deja detenu")
+        except BaseException:
+            os.close(fd)
+            raise
+
+        logger.log("LOCK", f"⏳ Attente du verrou {self.lock_key}...")
+        future = asyncio.get_running_loop().run_in_executor(_lock_executor, fcntl.flock, fd, fcntl.LOCK_EX)
+        try:
+            done, _ = await asyncio.wait({future}, timeout=timeout)
+        except BaseException:
+            _release_file_lock_when_acquired(future, fd)
+            raise
+        if not done:
+            _release_file_lock_when_acquired(future, fd)
+            raise LockAcquisitionError(f"Impossible d'acquerir le verrou {self.lock_key} apres {timeout:.0f}s")
+        try:
+            future.result()
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+    async def _acquire_polling(self, timeout: float) -> None:
+        start_time = time.time()
+        while True:
+            if await acquire_lock(self.lock_key, self.instance_id, self.duration):
+                return
+            if time.time() - start_time >= timeout:
+                raise LockAcquisitionError(f"Impossible d'acquerir le verrou {self.lock_key} apres {timeout:.0f}s")
+            logger.log("LOCK", f"⏳ Attente du verrou {self.lock_key}...")
+            await asyncio.sleep(1)
+
 
 class LockAcquisitionError(Exception):
     pass
@@ -320,6 +870,11 @@ async def cleanup_expired_kodi_codes():
 
 async def teardown_database():
     try:
+        await flush_anime_requests()
+    except Exception as e:
+        logger.warning(f"Echec de l'enregistrement des demandes par anime: {e}")
+    try:
+        await _advisory_session.close()
         await database.disconnect()
     except Exception as e:
         logger.error(f"Erreur lors de la fermeture de la base de donnees: {e}")
@@ -0,0 +1,574 @@
+import os
+import re
+import sys
+import html
+import mmap
+import time
+import struct
+import asyncio
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Iterable, NamedTuple, Optional
+from urllib.parse import parse_qs, quote, urlparse
+
+import orjson
+
+try:
+    import fcntl
+except ImportError:  # Windows : pas de verrou entre workers, chacun vérifie le dataset de son côté
+    fcntl = None
+
+from fkstream.utils.common_logger import logger
+from fkstream.utils.general import normalize_name
+from fkstream.utils.models import settings
+from fkstream.utils.magnet_store import set_magnet_resolver
+from fkstream.utils.response_cache import stream_cache
+from fkstream.utils.stream_utils import prune_file_matches
+
+_INFO_HASH_PATTERN = re.compile(r"btih:([a-fA-F0-9]{40})")
+
+# Format du snapshot : MAGIC | longueur de l'en-tête (uint64) | en-tête JSON | blocs JSON des animes
+_SNAPSHOT_MAGIC = b"FKDS1\n"
+_SNAPSHOT_HEADER_LENGTH = struct.Struct("<Q")
+
+
+class TorrentRecord(NamedTuple):
+    """Torrent du dataset, pré-analysé au chargement (les trackers sont internés)."""
+    info_hash: str
+    trackers: tuple[str, ...]
+    files: tuple[str, ...]
+    size: int
+    seeders: Optional[int]
+
+    @property
+    def magnet_link(self) -> str:
+        return f"magnet:?xt=urn:btih:{self.info_hash}" + "".join(f"&tr={quote(tr, safe='')}" for tr in self.trackers)
+
+
+class AnimeEntry(NamedTuple):
+    api_id: str
+    name: str
+    torrents: tuple[TorrentRecord, ...]
+
+
+def extract_trackers_from_magnet(magnet_uri: str) -> list:
+    try:
+        decoded_uri = html.unescape(magnet_uri)
+        parsed = urlparse(decoded_uri)
+        params = parse_qs(parsed.query)
+        return params.get("tr", [])
+    except Exception as e:
+        logger.error(f"Échec extraction trackers du magnet: {e}")
+        return []
+
+
+def parse_torrent_source(source: dict, tracker_pool: dict) -> Optional[TorrentRecord]:
+    """
+    Convertit une source brute du dataset en TorrentRecord.
+    Les listes de trackers identiques sont partagées via tracker_pool pour limiter la mémoire.
+    """
+    magnet = source.get("magnet")
+    if not magnet:
+        return None
+    info_hash_match = _INFO_HASH_PATTERN.search(magnet)
+    if not info_hash_match:
+        return None
+
+    trackers = tuple(sys.intern(tr) for tr in extract_trackers_from_magnet(magnet))
+    trackers = tracker_pool.setdefault(trackers, trackers)
+
+    return TorrentRecord(
+        info_hash=sys.intern(info_hash_match.group(1).lower()),
+        trackers=trackers,
+        files=tuple(source.get("files") or ()),
+        size=source.get("size", 0),
+        seeders=source.get("seeders"),
+    )
+
+
+def parse_anime_entry(anime: dict, tracker_pool: dict) -> AnimeEntry:
+    """Ne conserve d'une entrée brute du dataset que les champs utilisés par FKStream."""
+    torrents = []
+    for source in anime.get("sources", []):
+        record = parse_torrent_source(source, tracker_pool)
+        if record:
+            torrents.append(record)
+
+    api_id = anime.get("api_id")
+    return AnimeEntry(
+        api_id=str(api_id) if api_id is not None else "",
+        name=anime.get("name", ""),
+        torrents=tuple(torrents),
+    )
+
+
+class DatasetIndex:
+    """
+    Index en mémoire du dataset Fankai, construit une seule fois au chargement.
+    Permet de retrouver un anime par api_id, nom normalisé ou info hash en temps constant,
+    avec ses torrents déjà analysés.
+    """
+
+    def __init__(self, entries: Iterable[AnimeEntry] = ()):
+        self.by_api_id: dict[str, int] = {}
+        self.by_name: dict[str, int] = {}
+        self.by_hash: dict[str, int] = {}
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.stats: dict = {}
+        self._entries: list[AnimeEntry] = []
+
+        for entry in entries:
+            self._register(len(self._entries), entry.api_id, entry.name, [t.info_hash for t in entry.torrents])
+            self._entries.append(entry)
+
+    def _register(self, position: int, api_id: str, name: str, info_hashes: list[str]) -> None:
+        if api_id:
+            self.by_api_id.setdefault(api_id, position)
+        name_norm = normalize_name(name)
+        if name_norm:
+            self.by_name.setdefault(name_norm, position)
+        for info_hash in info_hashes:
+            self.by_hash.setdefault(info_hash, position)
+
+    def _entry(self, position: int) -> AnimeEntry:
+        return self._entries[position]
+
+    def entries(self) -> Iterable[AnimeEntry]:
+        return (self._entry(position) for position in range(len(self)))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def contains(self, api_id: str, name_norm: str) -> bool:
+        return api_id in self.by_api_id or name_norm in self.by_name
+
+    def get_magnet_link(self, info_hash: str) -> Optional[str]:
+        info_hash = info_hash.lower()
+        position = self.by_hash.get(info_hash)
+        if position is None:
+            return None
+        record = next((t for t in self._entry(position).torrents if t.info_hash == info_hash), None)
+        return record.magnet_link if record else None
+
+    def find_anime(self, anime_id: str, anime_name: str) -> Optional[AnimeEntry]:
+        """
+        Retrouve l'entrée du dataset par api_id, avec fallback par nom normalisé
+        lorsque l'api_id pointe vers un autre anime (les IDs /series et /dataset peuvent diverger).
+        """
+        anime_name_norm = normalize_name(anime_name)
+        position = self.by_api_id.get(anime_id)
+        target = self._entry(position) if position is not None else None
+
+        if target and normalize_name(target.name) != anime_name_norm:
+            logger.warning(f"api_id {anime_id} a trouvé '{target.name}' au lieu de '{anime_name}', fallback par nom")
+            target = None
+
+        if not target and anime_name_norm:
+            position = self.by_name.get(anime_name_norm)
+            if position is not None:
+                target = self._entry(position)
+                logger.info(f"Fallback par nom: '{anime_name}' trouvé dans le dataset (api_id dataset: {target.api_id})")
+
+        return target
+
+
+class MappedDatasetIndex(DatasetIndex):
+    """
+    Index du dataset adossé au snapshot projeté en mémoire (mmap).
+    Seuls l'en-tête et les index de clés sont chargés dans le processus : les torrents restent
+    dans les pages du fichier, partagées entre tous les workers, et sont décodés à la demande.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        with open(path, "rb") as f:
+            file_stat = os.fstat(f.fileno())
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._file_id = (file_stat.st_ino, file_stat.st_mtime_ns)
+        self.path = path
+
+        if self._mm[:len(_SNAPSHOT_MAGIC)] != _SNAPSHOT_MAGIC:
+            self._mm.close()
+            raise ValueError("format de snapshot inconnu")
+        header_start = len(_SNAPSHOT_MAGIC) + _SNAPSHOT_HEADER_LENGTH.size
+        (header_length,) = _SNAPSHOT_HEADER_LENGTH.unpack_from(self._mm, len(_SNAPSHOT_MAGIC))
+        header = orjson.loads(self._mm[header_start:header_start + header_length])
+        body_start = header_start + header_length
+
+        self.etag = header.get("etag")
+        self.last_modified = header.get("last_modified")
+        self.saved_at = header.get("saved_at")
+        self._tracker_sets = [tuple(sys.intern(tr) for tr in trackers) for trackers in header["tracker_sets"]]
+        self._names: list[tuple[str, str]] = []
+        self._spans: list[tuple[int, int]] = []
+
+        for api_id, name, offset, length, info_hashes in header["animes"]:
+            self._register(len(self._spans), api_id, name, info_hashes)
+            self._names.append((api_id, name))
+            self._spans.append((body_start + offset, body_start + offset + length))
+
+    @property
+    def mapped_bytes(self) -> int:
+        return len(self._mm)
+
+    def _entry(self, position: int) -> AnimeEntry:
+        start, end = self._spans[position]
+        api_id, name = self._names[position]
+        torrents = tuple(
+            TorrentRecord(info_hash, self._tracker_sets[tracker_set], tuple(files), size, seeders)
+            for info_hash, tracker_set, files, size, seeders in orjson.loads(self._mm[start:end])
+        )
+        return AnimeEntry(api_id, name, torrents)
+
+    def __len__(self) -> int:
+        return len(self._spans)
+
+    def snapshot_changed(self) -> bool:
+        """Indique si un autre worker a remplacé le fichier du snapshot depuis sa projection."""
+        try:
+            file_stat = os.stat(self.path)
+        except OSError:
+            return False
+        return (file_stat.st_ino, file_stat.st_mtime_ns) != self._file_id
+
+
+def install_dataset_index(app_state, dataset_index: DatasetIndex) -> None:
+    """Publie un nouvel index sur l'état de l'application."""
+    app_state.dataset_index = dataset_index
+    stream_cache.clear()
+    set_magnet_resolver(dataset_index.get_magnet_link)
+    prune_file_matches(dataset_index.by_hash.keys())
+
+
+def _process_memory() -> dict:
+    """Mémoire du processus courant : RSS et, sous Linux, PSS (pages partagées réparties entre processus)."""
+    memory = {}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("Rss", "Pss"):
+                    memory[f"{key.lower()}_bytes"] = int(value.split()[0]) * 1024
+    except OSError:
+        try:
+            import resource
+            memory["rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        except ImportError:
+            pass
+    return memory
+
+
+def _format_memory(memory: dict) -> str:
+    return ", ".join(f"{key.split('_')[0].upper()} {value / 1024 ** 2:.1f} Mo" for key, value in memory.items()) or "n/a"
+
+
+class DatasetStreamParser:
+    """
+    Décodeur incrémental du dataset : reçoit le corps de /dataset par morceaux et décode
+    chaque entrée du tableau "top" dès qu'elle est complète, sans jamais matérialiser
+    le document entier. Seuls les champs utiles sont conservés (voir parse_anime_entry).
+    Les octets reçus ne sont parcourus qu'une fois : la profondeur d'imbrication est suivie
+    d'un morceau à l'autre et chaque entrée est décodée une seule fois, à son crochet fermant.
+    """
+
+    _TOP_ARRAY_PATTERN = re.compile(rb'"top"\s*:\s*\[')
+    _SEPARATOR_PATTERN = re.compile(rb"[\s,]*")
+    # Contenu jusqu'au prochain crochet ou accolade structurel, chaînes complètes comprises
+    _SKIP_PATTERN = re.compile(rb'[^"\[\]{}]*+(?:"[^"\\]*+(?:\\.[^"\\]*+)*+"[^"\[\]{}]*+)*+', re.DOTALL)
+
+    def __init__(self):
+        self.entries: list[AnimeEntry] = []
+        self._tracker_pool: dict = {}
+        # Octets de l'entrée en cours (depuis son accolade ouvrante) et suivants
+        self._buffer = bytearray()
+        self._scanned = 0
+        self._depth = 0
+        self._in_top = False
+        self._done = False
+
+    def feed(self, chunk: bytes) -> None:
+        if self._done:
+            return
+        buffer = self._buffer
+        buffer += chunk
+
+        if not self._in_top:
+            match = self._TOP_ARRAY_PATTERN.search(buffer)
+            if not match:
+                # Garder de quoi reconnaître '"top": [' s'il est coupé entre deux morceaux
+                del buffer[:-64]
+                return
+            self._in_top = True
+            del buffer[:match.end()]
+
+        position, depth, entry_start = self._scanned, self._depth, 0
+        while True:
+            if depth == 0:
+                position = entry_start = self._SEPARATOR_PATTERN.match(buffer, position).end()
+                if position >= len(buffer):
+                    break
+                if buffer[position] == ord("]"):
+                    self._done = True
+                    break
+            position = self._SKIP_PATTERN.match(buffer, position).end()
+            if position >= len(buffer) or buffer[position] == ord('"'):
+                # Fin des octets reçus, ou chaîne coupée : reprise depuis son guillemet au morceau suivant
+                break
+            token = buffer[position]
+            position += 1
+            if token in b"[{":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    self.entries.append(parse_anime_entry(orjson.loads(bytes(buffer[entry_start:position])), self._tracker_pool))
+
+        if self._done:
+            self._buffer = bytearray()
+            return
+        # Seule l'entrée incomplète est conservée
+        consumed = entry_start if depth else position
+        del buffer[:consumed]
+        self._scanned = position - consumed
+        self._depth = depth
+
+    def close(self) -> list[AnimeEntry]:
+        if not self._done:
+            raise ValueError("dataset tronqué ou sans tableau 'top'")
+        return self.entries
+
+
+def _write_dataset_snapshot(dataset_index: DatasetIndex, meta: dict) -> None:
+    tracker_sets: dict[tuple, int] = {}
+    animes = []
+    blobs = []
+    offset = 0
+    for entry in dataset_index.entries():
+        blob = orjson.dumps([
+            [t.info_hash, tracker_sets.setdefault(t.trackers, len(tracker_sets)), t.files, t.size, t.seeders]
+            for t in entry.torrents
+        ])
+        animes.append([entry.api_id, entry.name, offset, len(blob), [t.info_hash for t in entry.torrents]])
+        blobs.append(blob)
+        offset += len(blob)
+    header = orjson.dumps({**meta, "tracker_sets": list(tracker_sets), "animes": animes})
+
+    path = settings.DATASET_SNAPSHOT_PATH
+    Path(os.path.dirname(path) or ".").mkdir(parents=True, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_SNAPSHOT_MAGIC)
+        f.write(_SNAPSHOT_HEADER_LENGTH.pack(len(header)))
+        f.write(header)
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp_path, path)
+
+
+async def save_dataset_snapshot(dataset_index: DatasetIndex) -> Optional[MappedDatasetIndex]:
+    """
+    Sauvegarde le dataset au format compact sur disque et retourne l'index projeté en mémoire
+    sur ce fichier, partagé entre les workers. Retourne None si le snapshot est désactivé ou en échec.
+    """
+    if not settings.DATASET_SNAPSHOT_PATH:
+        return None
+    try:
+        meta = {"etag": dataset_index.etag, "last_modified": dataset_index.last_modified, "saved_at": time.time()}
+        await asyncio.to_thread(_write_dataset_snapshot, dataset_index, meta)
+        mapped_index = await asyncio.to_thread(MappedDatasetIndex, settings.DATASET_SNAPSHOT_PATH)
+        logger.info(f"Snapshot du dataset sauvegardé: {settings.DATASET_SNAPSHOT_PATH} ({mapped_index.mapped_bytes / 1024:.0f} Ko)")
+        return mapped_index
+    except Exception as e:
+        logger.error(f"Erreur lors de la sauvegarde du snapshot du dataset: {e}")
+        return None
+
+
+async def load_dataset_snapshot() -> Optional[MappedDatasetIndex]:
+    """Projette le snapshot local en mémoire, ou retourne None s'il est absent ou illisible."""
+    if not settings.DATASET_SNAPSHOT_PATH or not os.path.exists(settings.DATASET_SNAPSHOT_PATH):
+        return None
+    try:
+        memory_before = _process_memory()
+        start_time = time.perf_counter()
+        dataset_index = await asyncio.to_thread(MappedDatasetIndex, settings.DATASET_SNAPSHOT_PATH)
+        load_time = time.perf_counter() - start_time
+    except Exception as e:
+        logger.error(f"Erreur lors de la lecture du snapshot du dataset: {e}")
+        return None
+    memory_after = _process_memory()
+
+    dataset_index.stats = {
+        "source": "snapshot",
+        "loaded_at": time.time(),
+        "saved_at": dataset_index.saved_at,
+        "mapped_bytes": dataset_index.mapped_bytes,
+        "parse_seconds": round(load_time, 3),
+        "animes": len(dataset_index),
+        "torrents": len(dataset_index.by_hash),
+        "memory_before": memory_before,
+        "memory_after": memory_after,
+    }
+    logger.log(
+        "FKSTREAM",
+        f"Dataset chargé depuis le snapshot: {len(dataset_index)} animes, {len(dataset_index.by_hash)} torrents en {load_time:.2f}s "
+        f"- mémoire du worker: {_format_memory(memory_before)} -> {_format_memory(memory_after)}",
+    )
+    return dataset_index
+
+
+def _build_dataset_index(parser: DatasetStreamParser) -> DatasetIndex:
+    """Termine l'analyse et construit les tables de recherche de l'index (by_api_id, by_name, by_hash)."""
+    return DatasetIndex(parser.close())
+
+
+async def fetch_dataset_index(http_client, current: Optional[DatasetIndex] = None) -> Optional[DatasetIndex]:
+    """
+    Télécharge le dataset en streaming et construit son index entrée par entrée,
+    hors de la boucle d'événements, tables de recherche comprises.
+    Envoie une requête conditionnelle (ETag / Last-Modified) si un index courant est fourni
+    et retourne None lorsque le dataset n'a pas changé (304).
+    L'index retourné est projeté depuis le snapshot lorsque celui-ci est activé.
+    """
+    headers = {"X-Dataset-API-Key": settings.API_KEY}
+    if current is not None:
+        if current.etag:
+            headers["If-None-Match"] = current.etag
+        if current.last_modified:
+            headers["If-Modified-Since"] = current.last_modified
+
+    memory_before = _process_memory()
+    start_time = time.perf_counter()
+    parser = DatasetStreamParser()
+    payload_size = 0
+    parse_time = 0.0
+
+    async with http_client.stream("GET", f"{settings.FANKAI_URL}/dataset", headers=headers) as response:
+        if response.status_code == 304:
+            current.stats["checked_at"] = time.time()
+            logger.info(f"Dataset inchangé (304) - vérifié en {time.perf_counter() - start_time:.2f}s")
+            return None
+
+        async for chunk in response.aiter_bytes():
+            payload_size += len(chunk)
+            parse_start = time.perf_counter()
+            await asyncio.to_thread(parser.feed, chunk)
+            parse_time += time.perf_counter() - parse_start
+        etag = response.headers.get("etag")
+        last_modified = response.headers.get("last-modified")
+
+    parse_start = time.perf_counter()
+    dataset_index = await asyncio.to_thread(_build_dataset_index, parser)
+    parse_time += time.perf_counter() - parse_start
+    download_time = time.perf_counter() - start_time - parse_time
+    dataset_index.etag = etag
+    dataset_index.last_modified = last_modified
+    del parser
+
+    mapped_index = await save_dataset_snapshot(dataset_index)
+    if mapped_index is not None:
+        dataset_index = mapped_index
+    memory_after = _process_memory()
+
+    dataset_index.stats = {
+        "source": "api",
+        "loaded_at": time.time(),
+        "checked_at": time.time(),
+        "payload_bytes": payload_size,
+        "mapped_bytes": mapped_index.mapped_bytes if mapped_index is not None else None,
+        "download_seconds": round(download_time, 3),
+        "parse_seconds": round(parse_time, 3),
+        "animes": len(dataset_index),
+        "torrents": len(dataset_index.by_hash),
+        "memory_before": memory_before,
+        "memory_after": memory_after,
+    }
+    logger.log(
+        "FKSTREAM",
+        f"Dataset chargé: {len(dataset_index)} animes, {len(dataset_index.by_hash)} torrents, "
+        f"{payload_size / 1024:.0f} Ko - téléchargement {download_time:.2f}s, analyse {parse_time:.2f}s "
+        f"- mémoire du worker: {_format_memory(memory_before)} -> {_format_memory(memory_after)}",
+    )
+    return dataset_index
+
+
+@asynccontextmanager
+async def _snapshot_publish_lock():
+    """
+    Verrou exclusif (flock) entre les workers de la machine, tenu pendant la vérification
+    du dataset et la publication du snapshot.
+    """
+    if fcntl is None or not settings.DATASET_SNAPSHOT_PATH:
+        yield
+        return
+    lock_path = f"{settings.DATASET_SNAPSHOT_PATH}.lock"
+    Path(os.path.dirname(lock_path) or ".").mkdir(parents=True, exist_ok=True)
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    future = asyncio.get_running_loop().run_in_executor(None, fcntl.flock, fd, fcntl.LOCK_EX)
+    try:
+        await asyncio.shield(future)
+    except BaseException:
+        # Un flock en attente dans son thread ne peut être interrompu : le descripteur est fermé à son issue
+        future.add_done_callback(lambda _: os.close(fd))
+        raise
+    try:
+        yield
+    finally:
+        os.close(fd)
+
+
+def _snapshot_published_since(current: Optional[DatasetIndex]) -> bool:
+    """Indique si le snapshot sur disque est plus récent que l'index courant (publié par un autre worker)."""
+    if not settings.DATASET_SNAPSHOT_PATH:
+        return False
+    if isinstance(current, MappedDatasetIndex):
+        return current.snapshot_changed()
+    return os.path.exists(settings.DATASET_SNAPSHOT_PATH)
+
+
+async def refresh_dataset(http_client, app_state) -> None:
+    """
+    Vérifie le dataset auprès de l'API et installe la nouvelle version, un worker à la fois.
+    Un worker qui attendait le verrou projette d'abord le snapshot publié entre-temps : sa requête
+    conditionnelle obtient alors un 304, le dataset n'est téléchargé qu'une fois et tous les workers
+    projettent le même fichier.
+    """
+    async with _snapshot_publish_lock():
+        snapshot_index = None
+        if _snapshot_published_since(getattr(app_state, "dataset_index", None)):
+            snapshot_index = await load_dataset_snapshot()
+            if snapshot_index is not None:
+                install_dataset_index(app_state, snapshot_index)
+
+        try:
+            dataset_index = await fetch_dataset_index(http_client, getattr(app_state, "dataset_index", None))
+        except Exception as e:
+            if snapshot_index is None:
+                raise
+            logger.warning(f"Vérification du dataset en échec, conservation du snapshot publié: {e}")
+            return
+        if dataset_index is not None:
+            install_dataset_index(app_state, dataset_index)
+
+
+async def periodic_dataset_update(http_client, app_state, initial_delay: Optional[int] = None):
+    """
+    Recharge le dataset à intervalle régulier. Un initial_delay de 0 déclenche une vérification
+    immédiate (démarrage depuis le snapshot), même si le rafraîchissement périodique est désactivé.
+    """
+    delay = settings.DATASET_REFRESH_INTERVAL if initial_delay is None else initial_delay
+    while True:
+        try:
+            await asyncio.sleep(delay)
+            logger.info("Vérification périodique du dataset")
+            await refresh_dataset(http_client, app_state)
+
+        except asyncio.CancelledError:
+            logger.log("FKSTREAM", "Tâche de mise à jour du dataset annulée")
+            break
+        except Exception as e:
+            logger.error(f"Erreur dans la tâche périodique du dataset: {e}")
+
+        if settings.DATASET_REFRESH_INTERVAL <= 0:
+            break
+        delay = settings.DATASET_REFRESH_INTERVAL
@@ -36,3 +36,23 @@ def normalize_name(name: str) -> str:
     nfkd = unicodedata.normalize('NFKD', name)
     without_accents = ''.join(c for c in nfkd if not unicodedata.combining(c))
     return ''.join(c for c in without_accents.lower() if c.isalnum())
+
+
+def fold_text(text: str) -> str:
+    """Même normalisation que normalize_name, mais les séparations entre mots sont conservées (un espace)."""
+    if not text:
+        return ""
+    nfkd = unicodedata.normalize('NFKD', text)
+    without_accents = ''.join(c for c in nfkd if not unicodedata.combining(c))
+    return ' '.join(''.join(c if c.isalnum() else ' ' for c in without_accents.lower()).split())
+
+
+# Durée minimale pendant laquelle Stremio peut resservir une réponse périmée si l'addon est en erreur
+STALE_ERROR_MAX_AGE = 7 * 86400
+
+
+def stremio_cache_hints(max_age: int) -> dict:
+    """Champs cacheMaxAge / staleRevalidate / staleError du protocole Stremio pour une durée de validité en secondes."""
+    if not max_age or max_age <= 0:
+        return {}
+    return {"cacheMaxAge": max_age, "staleRevalidate": max_age, "staleError": max(max_age, STALE_ERROR_MAX_AGE)}
@@ -1,6 +1,7 @@
 import logging
 import httpx
 import asyncio
+from contextlib import asynccontextmanager
 
 from .models import settings
 from .http_constants import DEFAULT_USER_AGENT, JSON_HEADERS
@@ -40,11 +41,22 @@ class HttpClient(BaseClient):
     async def post(self, url: str, **kwargs) -> httpx.Response:
         return await self._request("POST", url, **kwargs)
 
-    async def _request(self, method: str, url: str, **kwargs) -> httpx.Response:
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, **kwargs):
+        """Requête dont le corps est lu par morceaux via response.aiter_bytes(), sans être chargé en mémoire."""
+        response = await self._request(method, url, stream=True, **kwargs)
+        try:
+            yield response
+        finally:
+            await response.aclose()
+
+    async def _request(self, method: str, url: str, stream: bool = False, **kwargs) -> httpx.Response:
         if not url.startswith('http'):
             url = f"{self.base_url.rstrip('/')}/{url.lstrip('/')}"
         
         last_exception = None
+        # 304 n'est une réponse valide qu'aux requêtes conditionnelles ; pour les autres, c'est une erreur
+        conditional = any(name.lower() in ("if-none-match", "if-modified-since") for name in kwargs.get("headers") or {})
         
         for attempt in range(self.retries):
             try:
@@ -53,8 +65,13 @@ class HttpClient(BaseClient):
                 
                 self.logger.debug(f"{method} {url} (tentative {attempt + 1}/{self.retries})")
                 
-                response = await self.client.request(method, url, **kwargs)
-                response.raise_for_status()
+                if stream:
+                    request = self.client.build_request(method, url, **kwargs)
+                    response = await self.client.send(request, stream=True)
+                else:
+                    response = await self.client.request(method, url, **kwargs)
+                if not (conditional and response.status_code == 304):
+                    response.raise_for_status()
                 
                 self.logger.debug(f"{method} {url} → {response.status_code}")
                 return response
@@ -67,6 +84,7 @@ class HttpClient(BaseClient):
                     
             except httpx.HTTPStatusError as e:
                 last_exception = e
+                await e.response.aclose()
                 if e.response.status_code >= 500:
                     self.logger.warning(f"{method} {url} → {e.response.status_code} (tentative {attempt + 1}/{self.retries})")
                     if attempt < self.retries - 1:
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Callable, Optional
 from collections import OrderedDict
 import threading
 
@@ -9,6 +9,7 @@ class MagnetStore:
     def __init__(self):
         self._store: OrderedDict[str, str] = OrderedDict()
         self._lock = threading.RLock()
+        self._resolver: Optional[Callable[[str], Optional[str]]] = None
 
     def store_magnet_link(self, hash: str, magnet_link: str) -> None:
         with self._lock:
@@ -19,9 +20,17 @@ class MagnetStore:
             while len(self._store) > self._MAX_SIZE:
                 self._store.popitem(last=False)
 
+    def set_resolver(self, resolver: Optional[Callable[[str], Optional[str]]]) -> None:
+        """Définit une source de repli (ex: l'index du dataset) pour les hash non stockés."""
+        self._resolver = resolver
+
     def get_magnet_link(self, hash: str) -> Optional[str]:
         with self._lock:
-            return self._store.get(hash.lower())
+            magnet_link = self._store.get(hash.lower())
+        resolver = self._resolver
+        if magnet_link is None and resolver is not None:
+            return resolver(hash.lower())
+        return magnet_link
 
 # Instance globale pour la compatibilité ascendante
 _global_magnet_store = MagnetStore()
@@ -31,3 +40,6 @@ def store_magnet_link(hash: str, magnet_link: str) -> None:
 
 def get_magnet_link(hash: str) -> Optional[str]:
     return _global_magnet_store.get_magnet_link(hash)
+
+def set_magnet_resolver(resolver: Optional[Callable[[str], Optional[str]]]) -> None:
+    _global_magnet_store.set_resolver(resolver)
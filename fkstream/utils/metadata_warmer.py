@@ -0,0 +1,190 @@
+import asyncio
+import time
+import uuid
+from collections import deque
+from typing import Optional
+
+from fkstream.scrapers.fankai import FankaiAPI, _fetch_complete_anime_data
+from fkstream.utils.catalog import get_series_catalog
+from fkstream.utils.common_logger import logger
+from fkstream.utils.database import (
+    DistributedLock,
+    LockAcquisitionError,
+    acquire_lock,
+    extend_metadata_ttl,
+    flush_anime_requests,
+    get_anime_request_counts,
+    get_metadata_entry,
+    set_metadata_to_cache,
+)
+from fkstream.utils.models import settings
+
+# Délai avant le premier passage, pour ne pas concurrencer le démarrage
+_WARMER_INITIAL_DELAY = 60
+# Nombre de derniers résultats pris en compte pour le taux d'erreur, et minimum avant de pouvoir interrompre
+_ERROR_WINDOW = 20
+_ERROR_MIN_SAMPLES = 10
+# Fréquence des logs de progression
+_PROGRESS_LOG_EVERY = 50
+
+
+class MetadataWarmer:
+    """
+    Synchronise le cache de métadonnées (fk:list et fk:{id}) avec l'API Fankai, les séries les plus demandées en premier.
+    Chaque passage récupère la liste des séries, puis compare le last_update de chacune avec celui de l'entrée en cache :
+    seules les séries modifiées ou absentes sont récupérées en entier, les autres voient simplement leur TTL prolongé.
+    """
+
+    def __init__(self):
+        self.instance_id = f"fkstream_warmer_{uuid.uuid4().hex[:12]}"
+        self.running = False
+        self.last_run: Optional[dict] = None
+        self._progress = self._new_progress(0)
+
+    @staticmethod
+    def _new_progress(total: int) -> dict:
+        return {"total": total, "done": 0, "refreshed": 0, "extended": 0, "unchanged": 0, "failed": 0, "skipped": 0}
+
+    def stats(self) -> dict:
+        return {
+            "interval": settings.METADATA_WARMER_INTERVAL,
+            "running": self.running,
+            "progress": dict(self._progress) if self.running else None,
+            "last_run": self.last_run,
+        }
+
+    async def _sync_series_list(self, fankai_api: FankaiAPI) -> Optional[list]:
+        series_list = await fankai_api.get_all_series()
+        if not series_list:
+            return None
+        # Liste identique en base (et non dans le cache mémoire, propre au worker) : on prolonge l'entrée
+        entry = await get_metadata_entry("fk:list")
+        if entry is not None and series_list == entry[0]:
+            await extend_metadata_ttl("fk:list")
+        else:
+            await set_metadata_to_cache("fk:list", series_list)
+        return series_list
+
+    async def _refetch(self, fankai_api: FankaiAPI, anime_id: str) -> Optional[bool]:
+        """True si l'entrée a été récupérée, False si l'API a échoué, None si un autre fetch est déjà en cours."""
+        try:
+            async with DistributedLock(f"metadata_fetch_{anime_id}", timeout=0):
+                anime_data = await _fetch_complete_anime_data(fankai_api, anime_id)
+                if not anime_data:
+                    return False
+                await set_metadata_to_cache(f"fk:{anime_id}", anime_data)
+                return True
+        except LockAcquisitionError:
+            return None
+
+    async def _sync_anime(self, fankai_api: FankaiAPI, series: dict, horizon: float) -> str:
+        anime_id = str(series.get("id"))
+        media_id = f"fk:{anime_id}"
+        upstream_update = series.get("last_update")
+        entry = await get_metadata_entry(media_id)
+
+        if entry is not None:
+            cached_anime, expires_at = entry
+            unchanged = upstream_update is not None and cached_anime.get("last_update") == upstream_update
+            if unchanged and expires_at < horizon:
+                await extend_metadata_ttl(media_id)
+                return "extended"
+            # Sans last_update exploitable, seule l'expiration prochaine déclenche une récupération
+            if unchanged or (upstream_update is None and expires_at >= horizon):
+                return "unchanged"
+
+        result = await self._refetch(fankai_api, anime_id)
+        return {True: "refreshed", False: "failed", None: "skipped"}[result]
+
+    async def run_once(self, http_client, dataset_index) -> dict:
+        fankai_api = FankaiAPI(http_client)
+        start_time = time.perf_counter()
+
+        series_list = await self._sync_series_list(fankai_api)
+        if not series_list:
+            logger.warning("Synchronisation des métadonnées annulée: liste des séries indisponible")
+            self.last_run = {**self._new_progress(0), "aborted": True, "duration": round(time.perf_counter() - start_time, 3), "finished_at": int(time.time())}
+            return self.last_run
+
+        # Seules les séries du catalogue (présentes dans le dataset) sont suivies, avec leur last_update tout juste récupéré
+        catalog = await get_series_catalog(fankai_api, dataset_index)
+        upstream = {str(series.get("id")): series for series in series_list}
+        ordered = [catalog.animes[position] for position in catalog.views["last_update"]]
+        ordered = [upstream.get(str(series.get("id")), series) for series in ordered]
+        # Demandes comptées par tous les workers et instances, y compris celles de ce worker encore en attente d'écriture
+        await flush_anime_requests()
+        request_counts = await get_anime_request_counts()
+        ordered.sort(key=lambda series: -request_counts.get(str(series.get("id")), 0))
+
+        queue = deque(ordered)
+        progress = self._progress = self._new_progress(len(queue))
+        horizon = time.time() + settings.METADATA_WARMER_INTERVAL
+        recent = deque(maxlen=_ERROR_WINDOW)
+        aborted = False
+
+        async def worker():
+            nonlocal aborted
+            while queue and not aborted:
+                series = queue.popleft()
+                try:
+                    outcome = await self._sync_anime(fankai_api, series, horizon)
+                except Exception as e:
+                    logger.warning(f"Synchronisation de fk:{series.get('id')} en échec: {e}")
+                    outcome = "failed"
+
+                progress["done"] += 1
+                progress[outcome] += 1
+                if progress["done"] % _PROGRESS_LOG_EVERY == 0:
+                    logger.info(f"🔥 Synchronisation des métadonnées: {progress['done']}/{progress['total']} ({progress['refreshed']} récupérée(s), {progress['failed']} échec(s))")
+                if outcome not in ("refreshed", "failed"):
+                    continue
+
+                recent.append(outcome == "refreshed")
+                error_rate = recent.count(False) / len(recent)
+                if not aborted and len(recent) >= _ERROR_MIN_SAMPLES and error_rate > settings.METADATA_WARMER_MAX_ERROR_RATE:
+                    aborted = True
+                    logger.warning(f"Synchronisation interrompue: taux d'erreur de l'API Fankai à {error_rate:.0%} sur les {len(recent)} dernières séries")
+
+        if queue:
+            self.running = True
+            try:
+                await asyncio.gather(*(worker() for _ in range(max(1, settings.METADATA_WARMER_CONCURRENCY))))
+            finally:
+                self.running = False
+
+        self.last_run = {**progress, "aborted": aborted, "duration": round(time.perf_counter() - start_time, 3), "finished_at": int(time.time())}
+        logger.log(
+            "FKSTREAM",
+            f"Synchronisation des métadonnées terminée en {self.last_run['duration']:.1f}s: {progress['refreshed']} récupérée(s), "
+            f"{progress['extended']} prolongée(s), {progress['unchanged']} à jour, {progress['failed']} échec(s), {progress['skipped']} ignorée(s)",
+        )
+        return self.last_run
+
+
+metadata_warmer = MetadataWarmer()
+
+
+async def periodic_metadata_warmup(http_client, app_state):
+    """
+    Lance un passage de synchronisation à chaque intervalle. Le verrou, pris pour la durée de l'intervalle
+    et jamais libéré, garantit qu'une seule instance (ou un seul worker) effectue chaque passage.
+    """
+    delay = _WARMER_INITIAL_DELAY
+    while True:
+        try:
+            await asyncio.sleep(delay)
+            delay = settings.METADATA_WARMER_INTERVAL
+
+            if not len(app_state.dataset_index):
+                continue
+            if not await acquire_lock("metadata_warmer", metadata_warmer.instance_id, settings.METADATA_WARMER_INTERVAL):
+                logger.debug("Synchronisation des métadonnées déjà effectuée par une autre instance pour cet intervalle.")
+                continue
+
+            await metadata_warmer.run_once(http_client, app_state.dataset_index)
+
+        except asyncio.CancelledError:
+            logger.log("FKSTREAM", "Tâche de synchronisation des métadonnées annulée")
+            break
+        except Exception as e:
+            logger.error(f"Erreur dans la tâche de synchronisation des métadonnées: {e}")
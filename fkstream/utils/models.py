@@ -19,6 +19,7 @@ class AppSettings(BaseSettings):
     FANKAI_URL: Optional[str] = None
     API_KEY: Optional[str] = None
     METADATA_TTL: Optional[int] = 86400  # 1 jour
+    METADATA_STALE_TTL: Optional[int] = 604800  # 7 jours
     DEBRID_AVAILABILITY_TTL: Optional[int] = 86400  # 1 jour
     SCRAPE_LOCK_TTL: Optional[int] = 300  # 5 minutes
     SCRAPE_WAIT_TIMEOUT: Optional[int] = 30  # 30 secondes
@@ -34,6 +35,22 @@ class AppSettings(BaseSettings):
     CUSTOM_SOURCE_PATH: Optional[str] = "data/custom_sources.json"
     CUSTOM_SOURCE_INTERVAL: Optional[int] = 3600
     CUSTOM_SOURCE_TTL: Optional[int] = 3600
+    DATASET_REFRESH_INTERVAL: Optional[int] = 3600
+    DATASET_SNAPSHOT_PATH: Optional[str] = "data/dataset.snapshot"
+    STREAM_CACHE_TTL: Optional[int] = 300  # 5 minutes
+    STREAM_CACHE_MAX_MB: Optional[int] = 64
+    CATALOG_PAGE_SIZE: Optional[int] = 100
+    META_CACHE_TTL: Optional[int] = 3600  # 1 heure
+    META_CACHE_MAX_MB: Optional[int] = 64
+    METADATA_MEMORY_CACHE_TTL: Optional[int] = 300  # 5 minutes
+    METADATA_MEMORY_CACHE_MAX_MB: Optional[int] = 64
+    METADATA_WARMER_INTERVAL: Optional[int] = 3600  # 1 heure
+    METADATA_WARMER_CONCURRENCY: Optional[int] = 2
+    METADATA_WARMER_MAX_ERROR_RATE: Optional[float] = 0.5
+    CACHE_CONTROL_MANIFEST: Optional[str] = "public, max-age=600"
+    CACHE_CONTROL_CATALOG: Optional[str] = "public, max-age=600"
+    CACHE_CONTROL_META: Optional[str] = "public, max-age=3600"
+    CACHE_CONTROL_STREAM: Optional[str] = "private, max-age=60"
 
     @field_validator("STREMTHRU_URL")
     def remove_trailing_slash(cls, v):
@@ -0,0 +1,221 @@
+import gzip
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import partial
+from typing import Callable, Hashable, Iterable, Optional
+
+from fastapi import Request, Response
+
+from fkstream.utils.models import settings
+
+try:
+    import brotli
+except ImportError:  # Roue indisponible sur certaines plateformes : seul gzip est alors proposé
+    brotli = None
+
+
+# En dessous de cette taille, la compression ne fait pas gagner assez pour justifier l'en-tête Vary
+_MIN_COMPRESS_SIZE = 1024
+# Encodages proposés, par ordre de préférence
+_ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+
+def _negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """Choisit l'encodage préféré accepté par le client (valeur q non nulle), ou None pour le corps brut."""
+    accepted = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    for encoding in _ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def hash_secret(value: Optional[str]) -> str:
+    """Empreinte courte d'une valeur sensible (clé API, config) utilisable dans une clé de cache."""
+    return hashlib.sha256((value or "").encode()).hexdigest()[:32]
+
+
+class CachedResponse:
+    """
+    Corps JSON pré-sérialisé, accompagné de son ETag (empreinte du contenu).
+    Pas de Last-Modified : la date de construction varie d'un worker à l'autre pour un même contenu,
+    seul l'ETag permet une revalidation cohérente entre workers.
+    Les variantes compressées sont calculées à la première demande puis conservées avec le corps.
+    """
+
+    __slots__ = ("body", "etag", "_encoded", "_on_grow")
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+        self._encoded: dict[str, bytes] = {}
+        # Prévient le ResponseCache qui détient la réponse qu'une variante compressée s'ajoute à sa taille
+        self._on_grow: Optional[Callable[[int], None]] = None
+
+    @property
+    def compressible(self) -> bool:
+        return len(self.body) >= _MIN_COMPRESS_SIZE
+
+    @property
+    def size(self) -> int:
+        """Taille en mémoire du corps et de ses variantes compressées."""
+        return len(self.body) + sum(len(body) for body in self._encoded.values())
+
+    def encoded(self, encoding: str) -> bytes:
+        body = self._encoded.get(encoding)
+        if body is None:
+            body = self._encoded[encoding] = _compress(self.body, encoding)
+            if self._on_grow is not None:
+                self._on_grow(len(body))
+        return body
+
+    def variant_etag(self, encoding: Optional[str]) -> str:
+        """ETag propre à chaque encodage, afin qu'un cache partagé ne confonde pas les variantes."""
+        return f'{self.etag[:-1]}-{encoding}"' if encoding else self.etag
+
+    def matches(self, tag: str) -> bool:
+        tag = tag.strip().removeprefix("W/")
+        return tag == self.etag or (tag.startswith(self.etag[:-1] + "-") and tag.endswith('"'))
+
+
+def is_not_modified(request: Request, cached: CachedResponse) -> bool:
+    """Évalue If-None-Match face à la représentation en cache."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(cached.matches(tag) for tag in if_none_match.split(","))
+
+
+def cached_json_response(request: Request, cached: CachedResponse, cache_control: Optional[str] = None) -> Response:
+    """
+    Réponse JSON avec ETag et Cache-Control, ou 304 si le client possède déjà cette version.
+    Le corps est servi compressé (brotli ou gzip) selon Accept-Encoding.
+    """
+    encoding = None
+    headers = {}
+    if cached.compressible:
+        encoding = _negotiate_encoding(request.headers.get("accept-encoding", ""))
+        headers["Vary"] = "Accept-Encoding"
+    headers["ETag"] = cached.variant_etag(encoding)
+    if cache_control:
+        headers["Cache-Control"] = cache_control
+    if is_not_modified(request, cached):
+        return Response(status_code=304, headers=headers)
+    if encoding is None:
+        return Response(content=cached.body, media_type="application/json", headers=headers)
+    headers["Content-Encoding"] = encoding
+    return Response(content=cached.encoded(encoding), media_type="application/json", headers=headers)
+
+
+class ResponseCache:
+    """
+    Cache thread-safe de réponses pré-sérialisées, avec expiration (TTL) et éviction LRU.
+    Borné par la taille cumulée des corps et de leurs variantes compressées, et par le nombre d'entrées.
+    Chaque entrée peut porter des étiquettes permettant de l'invalider sans connaître sa clé complète,
+    et la version du contenu partagé (en base) sur laquelle elle a été construite : une entrée dont la
+    version ne correspond plus à celle lue par l'appelant est ignorée, y compris si un autre worker l'a changée.
+    """
+
+    def __init__(self, max_bytes: int, max_entries: int = 10_000):
+        self.max_bytes = max_bytes
+        self._max_entries = max_entries
+        self._store: OrderedDict[Hashable, tuple[float, CachedResponse, tuple, Optional[str]]] = OrderedDict()
+        self._tags: dict[Hashable, set] = {}
+        self._bytes = 0
+        self._lock = threading.RLock()
+
+    def get(self, key: Hashable, version: Optional[str] = None) -> Optional[CachedResponse]:
+        with self._lock:
+            entry = self._store.get(key)
+            if entry is None:
+                return None
+            expires_at, cached, _, entry_version = entry
+            if expires_at <= time.time() or entry_version != version:
+                self._remove(key)
+                return None
+            self._store.move_to_end(key)
+            return cached
+
+    def set(self, key: Hashable, cached: CachedResponse, ttl: int, tags: Iterable[Hashable] = (), version: Optional[str] = None) -> None:
+        with self._lock:
+            if key in self._store:
+                self._remove(key)
+            if ttl <= 0 or cached.size > self.max_bytes:
+                return
+            tags = tuple(tags)
+            self._store[key] = (time.time() + ttl, cached, tags, version)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            self._bytes += cached.size
+            cached._on_grow = partial(self._grow, key, cached)
+            self._evict()
+
+    def _grow(self, key: Hashable, cached: CachedResponse, size: int) -> None:
+        with self._lock:
+            entry = self._store.get(key)
+            if entry is None or entry[1] is not cached:
+                return
+            self._bytes += size
+            self._evict()
+
+    def _evict(self) -> None:
+        while self._store and (self._bytes > self.max_bytes or len(self._store) > self._max_entries):
+            self._remove(next(iter(self._store)))
+
+    def invalidate(self, tag: Hashable) -> int:
+        """Supprime toutes les entrées portant l'étiquette donnée et retourne leur nombre."""
+        with self._lock:
+            keys = self._tags.pop(tag, ())
+            for key in list(keys):
+                self._remove(key)
+            return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            for _, cached, _, _ in self._store.values():
+                cached._on_grow = None
+            self._store.clear()
+            self._tags.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        return {"entries": len(self._store), "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+    def __len__(self) -> int:
+        return len(self._store)
+
+    def _remove(self, key: Hashable) -> None:
+        _, cached, tags, _ = self._store.pop(key)
+        cached._on_grow = None
+        self._bytes -= cached.size
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+# Réponses de /stream, étiquetées par (media_id, service debrid) pour l'invalidation sur changement de disponibilité
+stream_cache = ResponseCache(max_bytes=(settings.STREAM_CACHE_MAX_MB or 0) * 1024 * 1024)
+# Réponses de /meta, étiquetées par media_id pour l'invalidation lors de l'écriture des métadonnées
+meta_cache = ResponseCache(max_bytes=(settings.META_CACHE_MAX_MB or 0) * 1024 * 1024)
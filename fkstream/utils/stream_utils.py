@@ -3,6 +3,7 @@ import time
 import unicodedata
 from fkstream.utils.common_logger import logger
 from fkstream.utils.models import Episode
+from fkstream.utils.response_cache import stream_cache
 
 def bytes_to_size(bytes_val: int) -> str:
     if not isinstance(bytes_val, (int, float)) or bytes_val == 0:
@@ -19,6 +20,7 @@ def bytes_to_size(bytes_val: int) -> str:
 _rename_map_cache: dict | None = None
 _rename_map_cache_time: float = 0
 _RENAME_MAP_TTL = 604800  # 7 jours
+_RENAME_MAP_RETRY_DELAY = 3600  # nouvel essai après un échec, en gardant la liste existante
 
 def _normalize_filename_for_matching(filename: str) -> str:
     if not filename:
@@ -64,6 +66,8 @@ async def _get_rename_map(http_client) -> dict:
                 old, new = line.split(' -> ', 1)
                 rename_map[old.strip()] = new.strip()
 
+        if _rename_map_cache is not None and rename_map != _rename_map_cache:
+            _invalidate_rename_dependent_matches()
         _rename_map_cache = rename_map
         _rename_map_cache_time = time.time()
         logger.info(f"Liste de renommage chargée avec succès ({len(rename_map)} entrées).")
@@ -73,11 +77,140 @@ async def _get_rename_map(http_client) -> dict:
         logger.error(f"Erreur lors de la récupération de la liste de renommage: {e}")
         if _rename_map_cache is not None:
             logger.info("Utilisation du cache existant de la liste de renommage.")
+            _rename_map_cache_time = time.time() - _RENAME_MAP_TTL + _RENAME_MAP_RETRY_DELAY
             return _rename_map_cache
         _rename_map_cache = {}
         _rename_map_cache_time = time.time()
         return {}
 
+_MATCHABLE_EXTENSIONS = ('.mkv', '.mp4', '.avi')
+
+
+class _TorrentFileKeys:
+    """
+    Clés de matching pré-calculées pour les fichiers vidéo d'un torrent.
+    Chaque étape est une recherche dans un dict : un épisode ne parcourt jamais les fichiers.
+    """
+    __slots__ = ("exact", "normalized", "base_names", "renamed")
+
+    def __init__(self, files_in_torrent):
+        self.exact: dict[str, int] = {}
+        self.normalized: dict[str, int] = {}
+        self.base_names: list[tuple[int, str]] = []
+        # Nom renommé -> fichier, construit à la première recherche avec la liste de renommage
+        self.renamed: dict[str, int] | None = None
+        for index, file_title in enumerate(files_in_torrent):
+            if not file_title.lower().endswith(_MATCHABLE_EXTENSIONS):
+                continue
+            base_file_name = file_title.split('/')[-1].rsplit('.', 1)[0]
+            self.exact.setdefault(base_file_name, index)
+            self.normalized.setdefault(_normalize_filename_for_matching(base_file_name), index)
+            self.base_names.append((index, base_file_name))
+
+    def match(self, base_nfo_name: str, rename_map: dict | None, normalized_nfo_name: str | None = None) -> tuple[int | None, int]:
+        """
+        Retourne (index du fichier, étape ayant trouvé la correspondance) ; étape 0 = aucun match.
+        normalized_nfo_name évite de renormaliser le même nom d'épisode pour chaque torrent.
+        """
+        index = self.exact.get(base_nfo_name)
+        if index is not None:
+            return index, 1
+        if normalized_nfo_name is None:
+            normalized_nfo_name = _normalize_filename_for_matching(base_nfo_name)
+        index = self.normalized.get(normalized_nfo_name)
+        if index is not None:
+            return index, 2
+        if rename_map:
+            if self.renamed is None:
+                self.renamed = {}
+                for index, base_file_name in self.base_names:
+                    renamed = rename_map.get(base_file_name)
+                    if renamed is not None:
+                        self.renamed.setdefault(renamed, index)
+            index = self.renamed.get(base_nfo_name)
+            if index is not None:
+                return index, 3
+        return None, 0
+
+# Table des correspondances épisode -> fichier : {info_hash: {nom nfo: (index du fichier, étape)}}
+# Un hash identifie un contenu immuable, les entrées restent donc valides tant que le torrent
+# est présent dans le dataset. Seules celles qui dépendent de la liste de renommage
+# (étape 3 ou aucun match) sont recalculées quand cette liste change.
+_file_match_table: dict[str, dict[str, tuple[int | None, int]]] = {}
+# Animes dont tous les épisodes sont déjà dans la table : {(api_id, nom): noms nfo couverts}
+# Une requête chaude évite ainsi de parcourir épisodes × torrents.
+_computed_animes: dict[tuple[str, str], frozenset[str]] = {}
+
+
+def _base_nfo_name(nfo_filename: str) -> str:
+    return nfo_filename.rsplit('.nfo', 1)[0]
+
+
+async def precompute_episode_matches(http_client, anime_key: tuple[str, str], torrents, nfo_filenames: list[str]) -> None:
+    """
+    Calcule, pour chaque torrent, le meilleur fichier de chaque épisode encore absent de la table.
+    Les torrents sont des TorrentRecord du dataset (info_hash, files) ; anime_key identifie l'anime du dataset.
+    """
+    # La liste de renommage est revérifiée à l'expiration de son TTL, même si tout est déjà calculé :
+    # un changement invalide les entrées sans correspondance (étape 0) ou issues de la liste (étape 3)
+    if _rename_map_cache is not None and time.time() - _rename_map_cache_time >= _RENAME_MAP_TTL:
+        await _get_rename_map(http_client)
+
+    base_nfo_names = frozenset(_base_nfo_name(nfo) for nfo in nfo_filenames if nfo)
+    covered = _computed_animes.get(anime_key)
+    if covered is not None and base_nfo_names <= covered:
+        return
+
+    rename_map = None
+    normalized_nfo_names = {}
+    computed = 0
+    for torrent in torrents:
+        matches = _file_match_table.setdefault(torrent.info_hash, {})
+        missing = [name for name in base_nfo_names if name not in matches]
+        if not missing:
+            continue
+        if rename_map is None:
+            rename_map = await _get_rename_map(http_client)
+        file_keys = _TorrentFileKeys(torrent.files)
+        for base_nfo_name in missing:
+            normalized_nfo_name = normalized_nfo_names.get(base_nfo_name)
+            if normalized_nfo_name is None:
+                normalized_nfo_name = normalized_nfo_names[base_nfo_name] = _normalize_filename_for_matching(base_nfo_name)
+            matches[base_nfo_name] = file_keys.match(base_nfo_name, rename_map, normalized_nfo_name)
+        computed += len(missing)
+
+    _computed_animes[anime_key] = base_nfo_names
+    if computed:
+        logger.debug(f"Table de correspondances: {computed} entrée(s) calculée(s) pour {len(torrents)} torrent(s)")
+
+
+def get_matched_file_index(info_hash: str, nfo_filename: str) -> int | None:
+    if not nfo_filename:
+        return None
+    match = _file_match_table.get(info_hash, {}).get(_base_nfo_name(nfo_filename))
+    return match[0] if match else None
+
+
+def prune_file_matches(valid_hashes) -> None:
+    """Retire de la table les torrents qui ne sont plus dans le dataset."""
+    valid_hashes = set(valid_hashes)
+    # Les torrents d'un anime peuvent avoir changé avec le dataset
+    _computed_animes.clear()
+    stale_hashes = [info_hash for info_hash in _file_match_table if info_hash not in valid_hashes]
+    for info_hash in stale_hashes:
+        del _file_match_table[info_hash]
+    if stale_hashes:
+        logger.info(f"Table de correspondances: {len(stale_hashes)} torrent(s) retiré(s)")
+
+
+def _invalidate_rename_dependent_matches() -> None:
+    stream_cache.clear()
+    _computed_animes.clear()
+    for matches in _file_match_table.values():
+        for base_nfo_name in [name for name, (_, stage) in matches.items() if stage in (0, 3)]:
+            del matches[base_nfo_name]
+
+
 async def find_best_file_for_episode(http_client, files_in_torrent: list[dict], selected_episode: Episode) -> dict | None:
     """
     Trouve le fichier le plus pertinent en utilisant une stratégie de matching en 3 étapes.
@@ -86,51 +219,17 @@ async def find_best_file_for_episode(http_client, files_in_torrent: list[dict],
         logger.warning("Aucune information d'épisode (nfo_filename) fournie pour le matching.")
         return None
 
-    base_nfo_name = selected_episode.nfo_filename.rsplit('.nfo', 1)[0]
+    base_nfo_name = _base_nfo_name(selected_episode.nfo_filename)
+    file_keys = _TorrentFileKeys([file_info.get("title", "") for file_info in files_in_torrent])
 
-    # Étape 1: Match Exact
-    logger.debug(f"Étape 1: Recherche de correspondance exacte pour '{base_nfo_name}'")
-    for file_info in files_in_torrent:
-        file_title = file_info.get("title", "")
-        if not file_title.lower().endswith(('.mkv', '.mp4', '.avi')):
-            continue
-        
-        base_file_name = file_title.split('/')[-1].rsplit('.', 1)[0]
-        if base_nfo_name == base_file_name:
-            logger.info(f"✅ Étape 1: Succès - Correspondance exacte trouvée : '{file_title}'")
-            return file_info
-
-    # Étape 2: Match Normalisé
-    logger.debug("Étape 2: Recherche de correspondance normalisée...")
-    normalized_nfo = _normalize_filename_for_matching(base_nfo_name)
-    for file_info in files_in_torrent:
-        file_title = file_info.get("title", "")
-        if not file_title.lower().endswith(('.mkv', '.mp4', '.avi')):
-            continue
-            
-        base_file_name = file_title.split('/')[-1].rsplit('.', 1)[0]
-        normalized_file = _normalize_filename_for_matching(base_file_name)
-        if normalized_nfo == normalized_file:
-            logger.info(f"✅ Étape 2: Succès - Correspondance normalisée trouvée : '{file_title}'")
-            return file_info
-            
-    # Étape 3: Match avec liste de renommage
-    logger.debug("Étape 3: Recherche avec la liste de renommage...")
-    rename_map = await _get_rename_map(http_client)
-    if rename_map:
-        for file_info in files_in_torrent:
-            file_title = file_info.get("title", "")
-            if not file_title.lower().endswith(('.mkv', '.mp4', '.avi')):
-                continue
+    index, stage = file_keys.match(base_nfo_name, None)
+    if index is None:
+        logger.debug("Étape 3: Recherche avec la liste de renommage...")
+        index, stage = file_keys.match(base_nfo_name, await _get_rename_map(http_client))
 
-            base_file_name = file_title.split('/')[-1].rsplit('.', 1)[0]
-            
-            if base_file_name in rename_map:
-                renamed_file = rename_map[base_file_name]
-                if renamed_file == base_nfo_name:
-                    logger.info(f"✅ Étape 3: Succès - Correspondance par renommage trouvée : '{file_title}' -> '{renamed_file}'")
-                    return file_info
-
-    logger.warning(f"❌ Échec des 3 étapes. Aucune correspondance trouvée pour '{base_nfo_name}'")
-    return None
-    
+    if index is None:
+        logger.warning(f"❌ Échec des 3 étapes. Aucune correspondance trouvée pour '{base_nfo_name}'")
+        return None
+
+    logger.info(f"✅ Étape {stage}: Succès - Correspondance trouvée : '{files_in_torrent[index].get('title')}'")
+    return files_in_torrent[index]
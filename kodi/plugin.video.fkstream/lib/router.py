@@ -89,7 +89,16 @@ class Router:
             xbmcplugin.endOfDirectory(self.handle, succeeded=False)
             return
 
+        # Le catalogue est paginé côté serveur : on enchaîne les pages jusqu'à la dernière
         metas = data["metas"]
+        seen_ids = {anime.get("id") for anime in metas}
+        while metas:
+            data = api_get(build_catalog_url(search=search, genre=genre, sort=sort, skip=len(metas)))
+            page = [anime for anime in (data or {}).get("metas", []) if anime.get("id") not in seen_ids]
+            if not page:
+                break
+            seen_ids.update(anime.get("id") for anime in page)
+            metas.extend(page)
         items = []
 
         for anime in metas:
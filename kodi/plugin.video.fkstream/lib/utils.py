@@ -65,7 +65,7 @@ def api_get(path, timeout=15):
         return None
 
 
-def build_catalog_url(search=None, genre=None, sort=None):
+def build_catalog_url(search=None, genre=None, sort=None, skip=None):
     secret = get_secret_string()
     prefix = f"/{secret}" if secret else ""
     parts = []
@@ -75,6 +75,8 @@ def build_catalog_url(search=None, genre=None, sort=None):
         parts.append(f"genre={url_quote(genre, safe='')}")
     if sort:
         parts.append(f"sort={url_quote(sort, safe='')}")
+    if skip:
+        parts.append(f"skip={int(skip)}")
 
     if parts:
         return f"{prefix}/catalog/anime/fankai_catalog/{'&'.join(parts)}.json"